@@ -9,7 +9,8 @@ CONFIG_VERSION = 2
 
 def load_config() -> CommentedMap:
     yaml = YAML()
-    config: CommentedMap = yaml.load(open('config.yml'))
+    with open('config.yml') as config_file:
+        config: CommentedMap = yaml.load(config_file)
     config_changed = False
 
     if 'config_version' not in config:
@@ -39,6 +40,7 @@ def load_config() -> CommentedMap:
         config_changed = True
 
     if config_changed:
-        yaml.dump(config, open('config.yml', 'w'))
+        with open('config.yml', 'w') as config_file:
+            yaml.dump(config, config_file)
 
     return config
@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 """database handling for shazbuckbot"""
 
+import json
 import sqlite3
-from typing import List, Tuple
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
 
 from trueskill import Rating, expose
 
 from helper_classes import GameStatus, WagerResult, TimeDuration
 
-DATABASE_VERSION = 1
+DATABASE_VERSION = 4
 
 
 class DataBase:
@@ -20,30 +22,57 @@ class DataBase:
         :param int bot_discord_id: Discord id of the bot
         :param TimeDuration default_bet_window: The default bet window used if none specified
         """
-        self.conn = sqlite3.connect(db_file)
+        # Leave room in the statement cache for the IN queries, which differ per number of statuses
+        self.conn = sqlite3.connect(db_file, cached_statements=256)
+        # A single cursor is reused for all statements, results are always fetched before the next statement
+        self.cur = self.conn.cursor()
+        # Set while inside a transaction() block, the commit is then left to the end of the block
+        self.deferred_commit = False
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA cache_size = -20000")
+        self.conn.execute("PRAGMA mmap_size = 268435456")
         self.bot_discord_id = bot_discord_id
 
-        cur = self.conn.cursor()
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        if not cur.fetchall():
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        if not self.cur.fetchall():
             self.new_database()
 
-        cur = self.conn.cursor()
-        cur.execute("PRAGMA user_version")
-        data = cur.fetchone()
+        self.cur.execute("PRAGMA user_version")
+        data = self.cur.fetchone()
         db_version = 0
         if data:
             db_version = data[0]
         if db_version < DATABASE_VERSION:
             self.update_database(db_version, default_bet_window)
 
-        cur = self.conn.cursor()
-        cur.execute(''' SELECT id FROM users WHERE discord_id = ? ''', (bot_discord_id,))
-        self.bot_user_id = cur.fetchone()[0]
+        self.cur.execute(''' SELECT id FROM users WHERE discord_id = ? ''', (bot_discord_id,))
+        self.bot_user_id = self.cur.fetchone()[0]
 
     def close(self) -> None:
         self.conn.close()
 
+    @contextmanager
+    def transaction(self):
+        """Group all changes made inside the with block into a single transaction, which is committed at the end of the
+        block or rolled back if an exception is raised
+        """
+        self.deferred_commit = True
+        try:
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self.deferred_commit = False
+
+    def _commit(self) -> None:
+        """Commit the current transaction, unless inside a transaction() block"""
+        if not self.deferred_commit:
+            self.conn.commit()
+
     def new_database(self) -> None:
         """Initialize a new database"""
 
@@ -57,6 +86,7 @@ class DataBase:
                 balance INTEGER NOT NULL
             );
         """)
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_discord_id ON users(discord_id)")
         self.create_user((self.bot_discord_id, 'ShazBuckBot', 1, 0))
         self.conn.execute("""
             CREATE TABLE IF NOT EXISTS transfers (
@@ -109,9 +139,8 @@ class DataBase:
         :return:
         """
         if db_version < 1:
-            cur = self.conn.cursor()
-            cur.execute("SELECT COUNT(*) AS CNTREC FROM pragma_table_info('games') WHERE name='bet_window'")
-            data = cur.fetchone()
+            self.cur.execute("SELECT COUNT(*) AS CNTREC FROM pragma_table_info('games') WHERE name='bet_window'")
+            data = self.cur.fetchone()
             if data[0] == 0:
                 self.conn.execute(f"""
                     ALTER TABLE games ADD COLUMN bet_window INTEGER NOT NULL DEFAULT {default_bet_window.to_seconds}
@@ -120,19 +149,49 @@ class DataBase:
                 self.conn.execute("UPDATE games SET bet_window = bet_window * 60")
             self.conn.execute("PRAGMA user_version = 1")
             self.conn.commit()
+        if db_version < 2:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS trueskills (
+                    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                    discord_id INTEGER NOT NULL,
+                    game_id INT NOT NULL,
+                    mu FLOAT NOT NULL,
+                    sigma FLOAT NOT NULL,
+                    trueskill FLOAT NOT NULL
+                );
+            """)
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_trueskills_discord_game ON trueskills(discord_id, game_id)
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_wagers_game_result ON wagers(game_id, result)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_games_status ON games(status)")
+            self.conn.execute("PRAGMA user_version = 2")
+            self.conn.commit()
+        if db_version < 3:
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_discord_id ON users(discord_id)")
+            self.conn.execute("PRAGMA user_version = 3")
+            self.conn.commit()
+        if db_version < 4:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_transfers_sender ON transfers(sender)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_transfers_receiver ON transfers(receiver)")
+            self.conn.execute("PRAGMA user_version = 4")
+            self.conn.commit()
 
     def create_user(self, user) -> int:
         """Create a new user into the users table
     
         :param tuple[int,str,int,int] user: The discord_id, nick, mute_dm and balance
-        :return: The id of the user created
+        :return: The id of the user created or 0 if a user with that discord_id already exists
         """
         sql = ''' INSERT INTO users(discord_id,nick,mute_dm,balance,create_time)
-                  VALUES(?,?,?,?,strftime('%s','now')) '''
-        cur = self.conn.cursor()
-        cur.execute(sql, user)
-        self.conn.commit()
-        return cur.lastrowid
+                  VALUES(?,?,?,?,strftime('%s','now')) ON CONFLICT(discord_id) DO NOTHING RETURNING id '''
+        self.cur.execute(sql, user)
+        data = self.cur.fetchone()
+        self._commit()
+        if data:
+            return data[0]
+        else:
+            return 0
 
     def get_user_data(self, user_id, fields) -> tuple:
         """Get user data from database
@@ -142,9 +201,8 @@ class DataBase:
         :return: A tuple containing the requested data
         """
         fields = ', '.join(fields)
-        cur = self.conn.cursor()
-        cur.execute(f''' SELECT {fields} FROM users WHERE id = ? ''', (user_id,))
-        data = cur.fetchone()
+        self.cur.execute(f''' SELECT {fields} FROM users WHERE id = ? ''', (user_id,))
+        data = self.cur.fetchone()
         if data:
             return tuple(data)
         else:
@@ -158,23 +216,38 @@ class DataBase:
         :return: A tuple containing the requested data
         """
         fields = ', '.join(fields)
-        cur = self.conn.cursor()
-        cur.execute(f''' SELECT {fields} FROM users WHERE discord_id = ? ''', (discord_id,))
-        data = cur.fetchone()
+        self.cur.execute(f''' SELECT {fields} FROM users WHERE discord_id = ? ''', (discord_id,))
+        data = self.cur.fetchone()
         if data:
             return tuple(data)
         else:
             return tuple()
 
+    def get_users_data_by_discord_ids(self, discord_ids, fields) -> Dict[int, tuple]:
+        """Get user data of several users from database in a single query
+
+        :param list[int] discord_ids: The discord ids of the users
+        :param Tuple[str] fields: tuple of field names
+        :return: A dictionary by discord id of tuples containing the requested data, unknown users are left out
+        """
+        fields = ', '.join(fields)
+        sql = f''' SELECT discord_id, {fields} FROM users WHERE discord_id IN (SELECT value FROM json_each(?)) '''
+        self.cur.execute(sql, (json.dumps(list(discord_ids)),))
+        data = self.cur.fetchall()
+        users = {}
+        for user in data:
+            discord_id: int = user[0]
+            users[discord_id] = tuple(user[1:])
+        return users
+
     def get_top5(self) -> List[Tuple[str, int, int]]:
         """Returns the top 5
 
         :return: List of Tuples with the data of the top 5 (nick, discord_id and balance)
         """
         sql = ''' SELECT nick, discord_id, balance FROM users ORDER BY balance DESC LIMIT 5 '''
-        cur = self.conn.cursor()
-        cur.execute(sql)
-        data = cur.fetchall()
+        self.cur.execute(sql)
+        data = self.cur.fetchall()
         top5 = []
         for user in data:
             nick: str = user[0]
@@ -192,9 +265,8 @@ class DataBase:
                   AS total_sender_amount FROM users, transfers 
                   WHERE (users.id = receiver or users.id = sender) AND sender <> 1 AND receiver <> 1 
                   AND sender <> receiver GROUP BY nick ORDER BY total_sender_amount DESC LIMIT 5 '''
-        cur = self.conn.cursor()
-        cur.execute(sql)
-        data = cur.fetchall()
+        self.cur.execute(sql)
+        data = self.cur.fetchall()
         beggars = []
         for user in data:
             nick: str = user[0]
@@ -212,9 +284,8 @@ class DataBase:
                   AS total_sender_amount FROM users, transfers
                   WHERE (users.id = receiver or users.id = sender) AND sender <> 1 AND receiver <> 1 
                   AND sender <> receiver GROUP BY nick ORDER BY total_sender_amount DESC LIMIT 5 '''
-        cur = self.conn.cursor()
-        cur.execute(sql)
-        data = cur.fetchall()
+        self.cur.execute(sql)
+        data = self.cur.fetchall()
         beggars = []
         for user in data:
             nick: str = user[0]
@@ -235,9 +306,8 @@ class DataBase:
         fields_str = ' = ?, '.join(fields) + ' = ?'
         values += (user_id,)
         sql = f''' UPDATE users SET {fields_str} WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
 
     def change_balance(self, user_id, balance_change) -> None:
         """Change the balance of a user
@@ -247,9 +317,8 @@ class DataBase:
         """
         values = (balance_change, user_id)
         sql = ''' UPDATE users SET balance = balance + ? WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
 
     def create_transfer(self, transfer) -> int:
         """Create a new transfer into the transfers table and update the balances
@@ -260,14 +329,38 @@ class DataBase:
         """
         sql = ''' INSERT INTO transfers(sender, receiver, amount, transfer_time)
                   VALUES(?, ?, ?, strftime('%s','now')) '''
-        cur = self.conn.cursor()
-        cur.execute(sql, transfer)
-        self.conn.commit()
-        if (self.change_balance(transfer[0], -transfer[2]) == 0 or
-                self.change_balance(transfer[1], transfer[2]) == 0):
-            return 0
-        else:
-            return cur.lastrowid
+        self.cur.execute(sql, transfer)
+        transfer_id = self.cur.lastrowid
+        (sender, receiver, amount) = transfer
+        sql = ''' UPDATE users SET balance = balance + (CASE WHEN id = ? THEN ? ELSE 0 END)
+                                                + (CASE WHEN id = ? THEN ? ELSE 0 END)
+                  WHERE id IN (?, ?) '''
+        self.cur.execute(sql, (sender, -amount, receiver, amount, sender, receiver))
+        self._commit()
+        return transfer_id
+
+    def create_transfers(self, transfers) -> None:
+        """Create several new transfers into the transfers table and update the balances in a single transaction
+
+        :param List[tuple(int,int,int)] transfers: List of tuples of the user_id of the sender, user_id of the receiver
+            and the amount to be transferred
+        """
+        self._insert_transfers(transfers)
+        self._commit()
+
+    def _insert_transfers(self, transfers) -> None:
+        """Insert transfers into the transfers table and update the balances without committing
+
+        :param List[tuple(int,int,int)] transfers: List of tuples of the user_id of the sender, user_id of the receiver
+            and the amount to be transferred
+        """
+        sql = ''' INSERT INTO transfers(sender, receiver, amount, transfer_time)
+                  VALUES(?, ?, ?, strftime('%s','now')) '''
+        self.cur.executemany(sql, transfers)
+        balance_changes = [(-amount, sender) for (sender, receiver, amount) in transfers]
+        balance_changes += [(amount, receiver) for (sender, receiver, amount) in transfers]
+        sql = ''' UPDATE users SET balance = balance + ? WHERE id = ? '''
+        self.cur.executemany(sql, balance_changes)
 
     def create_game(self, game) -> int:
         """Create a new game into the games table
@@ -278,10 +371,9 @@ class DataBase:
         game += (GameStatus.PICKING.value,)
         sql = ''' INSERT INTO games(queue, start_time, team1, team2, bet_window, status)
                   VALUES(?, strftime('%s','now'), ?, ?, ?, ?) '''
-        cur = self.conn.cursor()
-        cur.execute(sql, game)
-        self.conn.commit()
-        return cur.lastrowid
+        self.cur.execute(sql, game)
+        self._commit()
+        return self.cur.lastrowid
 
     def cancel_game(self, game_id) -> None:
         """Update a game in the games table to Cancelled status
@@ -290,9 +382,8 @@ class DataBase:
         """
         values = (GameStatus.CANCELLED, game_id)
         sql = ''' UPDATE games SET status = ? WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
 
     def update_teams(self, game_id, teams) -> None:
         """Update a game in the games table to InProgress status
@@ -304,9 +395,8 @@ class DataBase:
         sql = ''' UPDATE games
                   SET team1 = ?, team2 = ?
                   WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
 
     def pick_game(self, game_id, teams) -> None:
         """Update a game in the games table to InProgress status
@@ -319,9 +409,8 @@ class DataBase:
                   SET pick_time = strftime('%s','now'), team1 = ?, team2 = ?, 
                   status = ? 
                   WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
 
     def finish_game(self, game_id, result) -> None:
         """Update a game into the games table with result
@@ -333,24 +422,23 @@ class DataBase:
             raise ValueError()
         values = (result, game_id)
         sql = ''' UPDATE games SET status = ? WHERE id = ?'''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
 
-    def get_games_by_status(self, status) -> List[Tuple[int, str, str, str, GameStatus, int, int, int]]:
+    def get_games_by_status(self, *statuses) -> List[Tuple[int, str, str, str, GameStatus, int, int, int]]:
         """Provide data on the currently running games
 
-        :param GameStatus status: The status of the games to search for
+        :param GameStatus statuses: The statuses of the games to search for
         :return: List of Tuples containing the game_id, team1, team2, queue, status, time since start, time since pick
-        and bet window for each game
+        and bet window for each game, ordered by status and game_id
         """
-        sql = ''' SELECT id, team1, team2, queue, status, 
+        placeholders = ', '.join('?' * len(statuses))
+        sql = f''' SELECT id, team1, team2, queue, status, 
                   CAST (((julianday('now') - julianday(start_time, 'unixepoch')) * 24 * 60 * 60) AS INTEGER),
                   CAST (((julianday('now') - julianday(pick_time, 'unixepoch')) * 24 * 60 * 60) AS INTEGER),
-                  bet_window FROM games WHERE status = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (status, ))
-        data = cur.fetchall()
+                  bet_window FROM games WHERE status IN ({placeholders}) ORDER BY status, id '''
+        self.cur.execute(sql, statuses)
+        data = self.cur.fetchall()
         games = []
         for game in data:
             game_id: int = game[0]
@@ -374,9 +462,8 @@ class DataBase:
                   CAST (((julianday('now') - julianday(start_time, 'unixepoch')) * 24 * 60 * 60) AS INTEGER),
                   CAST (((julianday('now') - julianday(pick_time, 'unixepoch')) * 24 * 60 * 60) AS INTEGER),
                   bet_window FROM games WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (game_id,))
-        data = cur.fetchone()
+        self.cur.execute(sql, (game_id,))
+        data = self.cur.fetchone()
         if data:
             game_id: int = data[0]
             teams: Tuple[str, str] = data[1:3]
@@ -397,9 +484,8 @@ class DataBase:
         :return: A tuple containing the requested data
         """
         fields = ', '.join(fields)
-        cur = self.conn.cursor()
-        cur.execute(f''' SELECT {fields} FROM games WHERE id = ? ''', (game_id,))
-        data = cur.fetchone()
+        self.cur.execute(f''' SELECT {fields} FROM games WHERE id = ? ''', (game_id,))
+        data = self.cur.fetchone()
         if data:
             return tuple(data)
         else:
@@ -415,17 +501,14 @@ class DataBase:
         sql = ''' INSERT INTO wagers(user_id, wager_time, game_id, prediction, 
                   amount, result)
                   VALUES(?, strftime('%s','now'), ?, ?, ?, ?) '''
-        cur = self.conn.cursor()
-        cur.execute(sql, wager)
-        self.conn.commit()
-        cur = self.conn.cursor()
-        cur.execute("SELECT id FROM users WHERE discord_id = ?", (self.bot_discord_id,))
-        bot_user_id: int = cur.fetchone()[0]
-        transfer = (wager[0], bot_user_id, wager[3])
+        self.cur.execute(sql, wager)
+        wager_id = self.cur.lastrowid
+        # The transfer commits the wager as well
+        transfer = (wager[0], self.bot_user_id, wager[3])
         if self.create_transfer(transfer) == 0:
             return 0
         else:
-            return cur.lastrowid
+            return wager_id
 
     def change_wager(self, wager_id, amount_change) -> None:
         """Change the wager amount
@@ -434,17 +517,11 @@ class DataBase:
         :param int amount_change: The amount the balance needs to change
         """
         values = (amount_change, wager_id)
-        sql = ''' UPDATE wagers SET amount = amount + ? WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
-        cur = self.conn.cursor()
-        cur.execute("SELECT user_id FROM wagers WHERE id = ?", (wager_id,))
-        user_id: int = cur.fetchone()[0]
-        cur = self.conn.cursor()
-        cur.execute("SELECT id FROM users WHERE discord_id = ?", (self.bot_discord_id,))
-        bot_user_id: int = cur.fetchone()[0]
-        transfer = (user_id, bot_user_id, amount_change)
+        sql = ''' UPDATE wagers SET amount = amount + ? WHERE id = ? RETURNING user_id '''
+        self.cur.execute(sql, values)
+        user_id: int = self.cur.fetchone()[0]
+        # The transfer commits the wager change as well
+        transfer = (user_id, self.bot_user_id, amount_change)
         self.create_transfer(transfer)
 
     def wager_result(self, wager_id, result) -> None:
@@ -457,24 +534,41 @@ class DataBase:
             raise ValueError()
         values = (result, wager_id)
         sql = ''' UPDATE wagers SET result = ? WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        self.conn.commit()
+        self.cur.execute(sql, values)
+        self._commit()
+
+    def settle_wagers(self, transfers, wager_results) -> None:
+        """Create the payout transfers and update the results of wagers in a single transaction
 
-    def get_wagers_from_game_id(self, game_id, wager_result) -> List[Tuple[int, int, GameStatus, int, str, int, str,
-                                                                           str]]:
+        :param List[tuple(int,int,int)] transfers: List of tuples of the user_id of the sender, user_id of the receiver
+            and the amount to be transferred
+        :param List[tuple(int,int)] wager_results: List of tuples of the result in the format of WAGER_RESULT and the
+            id of the wager to be updated
+        """
+        valid_results = set(r.value for r in WagerResult)
+        if any(result not in valid_results for (result, wager_id) in wager_results):
+            raise ValueError()
+        self._insert_transfers(transfers)
+        sql = ''' UPDATE wagers SET result = ? WHERE id = ? '''
+        self.cur.executemany(sql, wager_results)
+        self._commit()
+
+    def get_wagers_from_game_id(self, game_id, *wager_results) -> List[Tuple[int, int, GameStatus, int, str, int, str,
+                                                                             str]]:
         """Return all the data of the wagers placed on a certain game
         
         :param int game_id: Game id of the game
-        :param WagerResult wager_result: Only return wagers with this status
-        :return: List of wager data (id, user_id, prediction, amount, nick, discord_id, team1, team2)
+        :param WagerResult wager_results: Only return wagers with these statuses
+        :return: List of wager data (id, user_id, prediction, amount, nick, discord_id, team1, team2), ordered by status
+            and wager id
         """
-        sql = ''' SELECT wagers.id, user_id, prediction, amount, nick, discord_id, team1, team2 
+        placeholders = ', '.join('?' * len(wager_results))
+        sql = f''' SELECT wagers.id, user_id, prediction, amount, nick, discord_id, team1, team2 
                   FROM wagers, users, games 
-                  WHERE game_id = ? AND users.id = user_id AND games.id = game_id AND result = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (game_id, wager_result))
-        data = cur.fetchall()
+                  WHERE game_id = ? AND users.id = user_id AND games.id = game_id AND result IN ({placeholders})
+                  ORDER BY result, wagers.id '''
+        self.cur.execute(sql, (game_id,) + wager_results)
+        data = self.cur.fetchall()
         wagers = []
         for wager in data:
             wager_id: int = wager[0]
@@ -496,9 +590,8 @@ class DataBase:
         """
         sql = ''' SELECT id, prediction FROM wagers WHERE user_id = ? AND game_id = ? AND result = ? '''
         values = (user_id, game_id, WagerResult.INPROGRESS)
-        cur = self.conn.cursor()
-        cur.execute(sql, values)
-        data = cur.fetchone()
+        self.cur.execute(sql, values)
+        data = self.cur.fetchone()
         if data:
             return tuple(data)
         else:
@@ -514,10 +607,9 @@ class DataBase:
             raise ValueError
         sql = ''' INSERT INTO motds(discord_id, channel_id, start_time, message, end_time)
                   VALUES(?, ?, strftime('%s','now'), ?, strftime('%s','now') + ?) '''
-        cur = self.conn.cursor()
-        cur.execute(sql, motd)
-        self.conn.commit()
-        return cur.lastrowid
+        self.cur.execute(sql, motd)
+        self._commit()
+        return self.cur.lastrowid
 
     def end_motd(self, motd_id) -> None:
         """End a motd
@@ -525,9 +617,8 @@ class DataBase:
         :param int motd_id: The id of the motd to be ended
         """
         sql = ''' UPDATE motds SET end_time = strftime('%s','now') WHERE id = ? '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (motd_id,))
-        self.conn.commit()
+        self.cur.execute(sql, (motd_id,))
+        self._commit()
 
     def get_motd(self, channel_id, motd_id, *, general=False) -> Tuple[int, int, int, int, str]:
         """Get the currently active MOTDs
@@ -543,9 +634,8 @@ class DataBase:
         else:
             sql = ''' SELECT discord_id, channel_id, start_time, end_time, message FROM motds 
                       WHERE id = ? AND channel_id = ? AND end_time > strftime('%s','now') '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (motd_id, channel_id))
-        data = cur.fetchone()
+        self.cur.execute(sql, (motd_id, channel_id))
+        data = self.cur.fetchone()
         if data:
             return tuple(data)
         else:
@@ -564,9 +654,8 @@ class DataBase:
         else:
             sql = ''' SELECT id, discord_id, channel_id, start_time, end_time, message FROM motds 
                       WHERE channel_id = ? AND end_time > strftime('%s','now') '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (channel_id,))
-        data = cur.fetchall()
+        self.cur.execute(sql, (channel_id,))
+        data = self.cur.fetchall()
         motds = []
         for motd in data:
             motd_id: int = motd[0]
@@ -578,32 +667,33 @@ class DataBase:
             motds.append((motd_id, author_id, channel_id, start_time, end_time, message))
         return motds
 
-    def get_trueskill_rating(self, player_id) -> Tuple[int, int, int]:
-        """Return the trueskill rating of a player
+    def get_trueskill_ratings(self, player_ids) -> Dict[int, Tuple[float, float, int]]:
+        """Return the trueskill ratings of several players in a single query
 
-        :param int player_id: Discord id of the player
-        :return: Tuple of the mean and standard deviation of the trueskill rating and the number of recorded matches
+        :param list[int] player_ids: Discord ids of the players
+        :return: Dictionary by discord id of the mean and standard deviation of the trueskill rating and the number of
+            recorded matches, players without a rating are left out
         """
-        sql = ''' SELECT mu, sigma, ROW_NUMBER() OVER(ORDER BY game_id ASC) AS game_nr FROM trueskills 
-                  WHERE discord_id = ? ORDER BY game_id DESC LIMIT 1 '''
-        cur = self.conn.cursor()
-        cur.execute(sql, (player_id,))
-        data = cur.fetchone()
-        if data:
-            return tuple(data)
-        else:
-            return tuple()
-
-    def new_trueskill_rating(self, player_id, game_id, rating) -> None:
-        """
-
-        :param player_id: The id of the player to update
-        :param game_id: The id of the game that cause the update
-        :param Rating rating: The new player rating
-        :return:
+        sql = ''' SELECT discord_id, mu, sigma, game_nr FROM (
+                  SELECT discord_id, mu, sigma, COUNT(*) OVER(PARTITION BY discord_id) AS game_nr,
+                  ROW_NUMBER() OVER(PARTITION BY discord_id ORDER BY game_id DESC) AS row_nr
+                  FROM trueskills WHERE discord_id IN (SELECT value FROM json_each(?)) ) WHERE row_nr = 1 '''
+        self.cur.execute(sql, (json.dumps(list(player_ids)),))
+        data = self.cur.fetchall()
+        ratings = {}
+        for rating in data:
+            discord_id: int = rating[0]
+            ratings[discord_id] = tuple(rating[1:4])
+        return ratings
+
+    def new_trueskill_ratings(self, game_id, ratings) -> None:
+        """Store the new trueskill ratings of the players of a game in a single transaction
+
+        :param int game_id: The id of the game that caused the update
+        :param List[Tuple[int, Rating]] ratings: List of the discord id of each player and their new rating
         """
-        trueskill_update = (player_id, game_id, rating.mu, rating.sigma, expose(rating))
+        trueskill_updates = [(player_id, game_id, rating.mu, rating.sigma, expose(rating))
+                             for player_id, rating in ratings]
         sql = ''' INSERT INTO trueskills(discord_id, game_id, mu, sigma, trueskill) VALUES(?, ?, ?, ?, ?) '''
-        cur = self.conn.cursor()
-        cur.execute(sql, trueskill_update)
-        self.conn.commit()
+        self.cur.executemany(sql, trueskill_updates)
+        self._commit()
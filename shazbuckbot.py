@@ -8,11 +8,12 @@ import re
 import socket
 import sys
 import time
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 
 from datetime import datetime
+from functools import lru_cache
 from itertools import combinations, chain
-from math import sqrt, floor
+from math import sqrt, floor, exp, inf
 
 import unicodedata
 
@@ -23,7 +24,7 @@ import discord
 from aiohttp import ClientConnectorError
 from discord.ext import commands
 
-from trueskill import Rating, rate, quality, backends, BETA, global_env
+from trueskill import Rating, rate, backends, BETA, global_env
 
 from helper_classes import GameStatus, WagerResult, TimeDuration
 from config import load_config
@@ -48,11 +49,15 @@ REDFOX_DISCORD_ID: int = config['redfox_discord_id']
 PUG_CHANNEL_ID: int = config['pug_channel_id']
 BOT_CHANNEL_ID: int = config['bot_channel_id']
 DM_TIME_TO_WAIT = 0.21  # Seconds
+MAX_CONCURRENT_DMS = 5
+MAX_MESSAGE_LENGTH = 2000  # Characters, the discord limit
 DURATION_TOLERANCE = 30  # Minutes
 REACTIONS = ["👎", "👍"]
 TIE_PAYOUT_SCALE = 0.5
 MAX_RETRY_COUNT = 10
 RETRY_WAIT = 10  # Seconds
+MEMBER_CACHE_TTL = 300  # Seconds
+MEMBER_CACHE_SIZE = 4096
 TWITCH_GAME_ID = "517069"  # midair community edition
 TWITCH_CLIENT_ID: str = config['twitch_client_id']
 TWITCH_CLIENT_SECRET: str = config['twitch_client_secret']
@@ -60,77 +65,125 @@ MIN_NUM_GAMES_FOR_TS = 60
 DEFAULT_BET_WINDOW = TimeDuration.from_string(config['default_bet_window'])
 DEFAULT_MOTD_TIME = TimeDuration.from_string(config['default_motd_time'])
 DEBUG = 'DEBUG' in os.environ and os.environ['DEBUG'] == '1'
+# Authors whose messages are logged and, for game info, parsed (the bot itself only in debug mode)
+LOGGED_AUTHOR_IDS = frozenset((BULLYBOT_DISCORD_ID, DISCORD_ID))
+GAME_INFO_AUTHOR_IDS = LOGGED_AUTHOR_IDS if DEBUG else frozenset((BULLYBOT_DISCORD_ID,))
+BULLYBOT_MESSAGE_PATTERN = re.compile(r'Game.*?(?:(?P<begun>begun)|(?P<picked>picked)|(?P<cancelled>cancelled)|'
+                                      r'(?P<finished>finished))|(?P<replaced>has replaced .* as captain)|'
+                                      r'(?P<substituted>has been substituted with)|(?P<swapped>has been swapped with)')
 
 
-def caseless_equal(left, right):
-    def normalize_caseless(text):
-        return unicodedata.normalize("NFKD", text.casefold())
+def normalize_caseless(text):
+    return unicodedata.normalize("NFKD", text.casefold())
+
 
+def caseless_equal(left, right):
     return normalize_caseless(left) == normalize_caseless(right)
 
 
-def suggest_even_teams(db, player_ids) -> (List[int], List[int], float):
+def combine_messages(messages, max_length=MAX_MESSAGE_LENGTH) -> List[str]:
+    """Combine messages into as few newline separated messages as possible without exceeding the maximum length
+
+    :param List[str] messages: The messages to combine, in order
+    :param int max_length: The maximum length of a combined message
+    :return: List of combined messages, a single message that is too long is split at the maximum length
+    """
+    combined = []
+    for msg in messages:
+        if combined and len(combined[-1]) + 1 + len(msg) <= max_length:
+            combined[-1] += '\n' + msg
+        else:
+            combined += [msg[i:i + max_length] for i in range(0, len(msg), max_length)] or ['']
+    return combined
+
+
+@lru_cache(maxsize=None)
+def get_team_splits(size) -> Tuple[Tuple[int, ...], ...]:
+    """Return every distinct split of a number of players into two teams, only computed once per number of players
+
+    :param int size: Number of players
+    :return: Tuple of the indices of the players in the first team for each split
+    """
+    team_size = floor(size / 2)
+    if size and size % 2 == 0:
+        # A split and its mirror image give the same match, so keep the first player in the first team
+        return tuple((0,) + team1_idxs for team1_idxs in combinations(range(1, size), team_size - 1))
+    else:
+        return tuple(combinations(range(size), team_size))
+
+
+def suggest_even_teams(player_ratings, player_ids) -> (List[int], List[int], float):
     """Suggest even teams based on TrueSkill ratings
 
-    :param DataBase db: Connection to the database
+    :param dict[int, Optional[tuple[float, float, int]]] player_ratings: Trueskill rating data of the players by discord
+        id (mu, sigma and number of matches), None or missing if the player has no rating
     :param list[int] player_ids: List of discord ids
     :return: Two lists of discord ids and the chance to draw
     """
-    player_ratings = {}
+    mus = []
+    sigmas_sq = []
     for player_id in player_ids:
-        data = db.get_trueskill_rating(player_id)
-        if data:
-            player_ratings[player_id] = Rating(data[0], data[1])
-        else:
-            player_ratings[player_id] = Rating()
-    best_team1_ids = []
-    best_team2_ids = []
-    best_chance_to_draw = 0
-    for c in combinations(player_ids, floor(len(player_ids) / 2)):
-        team1_ids = list(c)
-        team2_ids = [x for x in player_ids if x not in team1_ids]
-        team1_rating = [player_ratings[i] for i in team1_ids]
-        team2_rating = [player_ratings[i] for i in team2_ids]
-        chance_to_draw = quality([team1_rating, team2_rating])
-        if chance_to_draw > best_chance_to_draw:
-            best_team1_ids = team1_ids
-            best_team2_ids = team2_ids
-            best_chance_to_draw = chance_to_draw
+        data = player_ratings.get(player_id)
+        rating = Rating(data[0], data[1]) if data else Rating()
+        mus.append(rating.mu)
+        sigmas_sq.append(rating.sigma ** 2)
+    # All players take part in every split, so only the difference in mu changes between splits
+    size = len(player_ids)
+    total_mu = sum(mus)
+    variance = size * (BETA * BETA) + sum(sigmas_sq)
+    # The chance to draw only decreases with the difference in mu, so search for the smallest difference
+    best_team1_idxs = ()
+    best_delta_mu = inf
+    for team1_idxs in get_team_splits(size):
+        delta_mu = abs(2 * sum(mus[i] for i in team1_idxs) - total_mu)
+        if delta_mu < best_delta_mu:
+            best_team1_idxs = team1_idxs
+            best_delta_mu = delta_mu
+    best_chance_to_draw = sqrt(size * (BETA * BETA) / variance) * exp(-best_delta_mu * best_delta_mu / (2 * variance))
+    best_team1_idxs = set(best_team1_idxs)
+    best_team1_ids = [player_ids[i] for i in range(size) if i in best_team1_idxs]
+    best_team2_ids = [player_ids[i] for i in range(size) if i not in best_team1_idxs]
     return best_team1_ids, best_team2_ids, best_chance_to_draw
 
 
-def calculate_win_chance(db, teams_ids) -> float:
+def calculate_win_amount(amount, prediction, total_amount, winning_amount) -> int:
+    """Calculate the payout of a correct wager in whole shazbucks
+
+    :param int amount: The amount of the wager
+    :param GameStatus prediction: The outcome the wager was placed on
+    :param int total_amount: The total amount bet on the game
+    :param int winning_amount: The total amount bet on the winning outcome
+    :return: The amount won
+    """
+    # The share is computed exactly as the payouts always have been, so claw-backs of earlier games match what was
+    # paid, both steps round half to even to an int
+    win_amount = round(amount * (total_amount / winning_amount))
+    if prediction == GameStatus.TIED:
+        win_amount = round(win_amount * TIE_PAYOUT_SCALE)
+    return win_amount
+
+
+def calculate_win_chance(player_ratings, teams_ids) -> float:
     """Calculate the chance for the first team to win
 
-    :param DataBase db: Connection to the database
+    :param dict[int, Optional[tuple[float, float, int]]] player_ratings: Trueskill rating data of the players by discord
+        id (mu, sigma and number of matches), None or missing if the player has no rating
     :param tuple[list[int], list[int]] teams_ids: Tuple of Lists of discord ids of players on each team
     :return: Chance for the first team to win
     """
     team_ratings = []
-    enough_data = True
     for team_ids in teams_ids:
         team_rating = []
         for player_id in team_ids:
-            data = db.get_trueskill_rating(player_id)
-            if data:
-                if data[2] < MIN_NUM_GAMES_FOR_TS:
-                    enough_data = False
-                    break
-                else:
-                    team_rating.append(Rating(data[0], data[1]))
-            else:
-                enough_data = False
-                break
-        if not enough_data:
-            break
+            data = player_ratings.get(player_id)
+            if not data or data[2] < MIN_NUM_GAMES_FOR_TS:
+                return 0
+            team_rating.append(Rating(data[0], data[1]))
         team_ratings.append(team_rating)
-    if enough_data:
-        delta_mu = sum(r.mu for r in team_ratings[0]) - sum(r.mu for r in team_ratings[1])
-        sum_sigma = sum(r.sigma ** 2 for r in chain(team_ratings[0], team_ratings[1]))
-        size = len(team_ratings[0]) + len(team_ratings[1])
-        return global_env().cdf(delta_mu / sqrt(size * (BETA * BETA) + sum_sigma))
-    else:
-        return 0
+    delta_mu = sum(r.mu for r in team_ratings[0]) - sum(r.mu for r in team_ratings[1])
+    sum_sigma = sum(r.sigma ** 2 for r in chain(team_ratings[0], team_ratings[1]))
+    size = len(team_ratings[0]) + len(team_ratings[1])
+    return global_env().cdf(delta_mu / sqrt(size * (BETA * BETA) + sum_sigma))
 
 
 def start_bot(db, ts, logger):
@@ -152,12 +205,43 @@ def start_bot(db, ts, logger):
 
         return commands.check(predicate)
 
+    # Discord members by discord id or nick together with the time the entry expires
+    member_cache = {}
+
+    def get_cached_member(key) -> Optional[discord.Member]:
+        """Return a discord member from the cache if it has not expired
+
+        :param int|str key: The discord id or the nick of the member
+        """
+        if key in member_cache:
+            expire_time, member = member_cache[key]
+            if expire_time > time.monotonic():
+                return member
+            del member_cache[key]
+        return None
+
+    def cache_member(key, member) -> None:
+        """Store a discord member in the cache
+
+        :param int|str key: The discord id or the nick of the member
+        :param discord.Member member: The discord member
+        """
+        now = time.monotonic()
+        if len(member_cache) >= MEMBER_CACHE_SIZE:
+            for expired_key in [k for k, (expire_time, _) in member_cache.items() if expire_time <= now]:
+                del member_cache[expired_key]
+            if len(member_cache) >= MEMBER_CACHE_SIZE:
+                del member_cache[next(iter(member_cache))]
+        member_cache[key] = (now + MEMBER_CACHE_TTL, member)
+
     async def fetch_member(discord_id) -> discord.Member:
         """Find the discord member based on their discord id
 
         :param int discord_id: The discord id of the user
         """
-        member = None
+        member = get_cached_member(discord_id)
+        if member:
+            return member
         for guild in bot.guilds:
             if guild.get_channel(BOT_CHANNEL_ID):
                 try:
@@ -170,6 +254,8 @@ def start_bot(db, ts, logger):
                     logger.error(f'Unable to fetch discord member by id {discord_id}:')
                     for line in str(e).split('\n'):
                         logger.error(f'\t{line}')
+        if member:
+            cache_member(discord_id, member)
         return member
 
     async def query_members(nick) -> discord.Member:
@@ -177,7 +263,9 @@ def start_bot(db, ts, logger):
 
         :param str nick: The nick of the user
         """
-        member = None
+        member = get_cached_member(nick)
+        if member:
+            return member
         for guild in bot.guilds:
             if guild.get_channel(BOT_CHANNEL_ID):
                 try:
@@ -196,8 +284,23 @@ def start_bot(db, ts, logger):
                     logger.error(f'Unable to fetch discord member from nickname {nick}:')
                     for line in str(e).split('\n'):
                         logger.error(f'\t{line}')
+        if member:
+            cache_member(nick, member)
         return member
 
+    async def get_capt_nicks(team_id_strs, queue) -> List[str]:
+        """Return the nicks of the captains of a game, or the outcomes for a custom game
+
+        :param Tuple[str, str] team_id_strs: The discord ids of the players per team, captain first
+        :param str queue: The queue the game was played in
+        :return: List of the nick of the captain of each team
+        """
+        if queue in ('NA', 'EU', 'AU', 'TestBranch'):
+            return list(await asyncio.gather(*(get_nick_from_discord_id(team_id_str.split()[0])
+                                               for team_id_str in team_id_strs)))
+        else:
+            return list(team_id_strs)
+
     async def get_nick_from_discord_id(discord_id: str) -> str:
         """Convert a discord id to a nick using discord or a database lookup
 
@@ -222,25 +325,91 @@ def start_bot(db, ts, logger):
             capt_nick = discord_id
         return capt_nick
 
+    # Trueskill rating data of the players of running games by game id and discord id
+    game_ratings = {}
+
+    def get_game_ratings(game_id, player_ids) -> Dict[int, Optional[Tuple[float, float, int]]]:
+        """Return the trueskill rating data of the players of a game, only fetching players that are not cached yet
+
+        :param int game_id: The id of the game
+        :param list[int] player_ids: List of discord ids of the players in the game
+        :return: Dictionary by discord id of the mean and standard deviation of the trueskill rating and the number of
+            recorded matches, None if the player has no rating
+        """
+        if game_id not in game_ratings:
+            prune_game_ratings()
+        ratings = game_ratings.setdefault(game_id, {})
+        missing_ids = [player_id for player_id in player_ids if player_id not in ratings]
+        if missing_ids:
+            data = db.get_trueskill_ratings(missing_ids)
+            for player_id in missing_ids:
+                ratings[player_id] = data.get(player_id)
+        return ratings
+
+    def prune_game_ratings() -> None:
+        """Forget the cached trueskill rating data of games that are no longer running, this includes games that were
+        ended outside of the bot, e.g. by utils/cancel_picking.py
+        """
+        running_game_ids = {game[0] for game in db.get_games_by_status(GameStatus.PICKING, GameStatus.INPROGRESS)}
+        for game_id in game_ratings.keys() - running_game_ids:
+            del game_ratings[game_id]
+
+    # Discord id and mute setting of users by user id, the discord id never changes and mute_dm only through cmd_mute
+    dm_settings = {}
+
+    def get_dm_settings(user_id) -> Tuple[int, int]:
+        """Return the discord id and mute setting of a user, only querying the database if not cached yet
+
+        :param int user_id: User id in database
+        :return: The discord id of the user and whether the user muted the bot's direct messages
+        """
+        settings = dm_settings.get(user_id)
+        if settings is None:
+            settings = db.get_user_data(user_id, ('discord_id, mute_dm',))
+            if settings:
+                dm_settings[user_id] = settings
+        return settings
+
     async def send_dm(user_id, message) -> None:
         """Send a discord DM to the user
 
         :param int user_id: User id in database
         :param str message: The message to be send to the user
         """
-        (discord_id, mute_dm) = db.get_user_data(user_id, ('discord_id, mute_dm',))
+        (discord_id, mute_dm) = get_dm_settings(user_id)
         if not mute_dm:
             user = await fetch_member(discord_id)
             if user:
                 try:
                     await asyncio.sleep(DM_TIME_TO_WAIT)
-                    await user.create_dm()
-                    await user.dm_channel.send(message)
+                    await user.send(message)
                 except discord.Forbidden as e:
                     logger.error(f'Unable to direct message discord member {user.display_name}:')
                     for line in str(e).split('\n'):
                         logger.error(f'\t{line}')
 
+    async def send_dms(messages) -> None:
+        """Send discord DMs to several users concurrently, combining the messages to the same user into as few DMs as
+        the discord message length limit allows
+
+        :param List[Tuple[int, str]] messages: List of the user id in database and the message to be send to that user
+        """
+        user_messages = {}
+        for (user_id, msg) in messages:
+            user_messages.setdefault(user_id, []).append(msg)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DMS)
+
+        async def send_limited_dm(user_id, msgs):
+            async with semaphore:
+                for message in combine_messages(msgs):
+                    await send_dm(user_id, message)
+
+        results = await asyncio.gather(*(send_limited_dm(user_id, msgs)
+                                         for (user_id, msgs) in user_messages.items()), return_exceptions=True)
+        for user_id, result in zip(user_messages, results):
+            if isinstance(result, Exception):
+                logger.error(f'Unable to direct message user {user_id}: {result!r}')
+
     async def cancel_wagers(game_id, reason) -> None:
         """Cancel wagers and return the bet to the users
 
@@ -248,19 +417,26 @@ def start_bot(db, ts, logger):
         :param str reason: The reason of the cancellation to send to the users in a DM
         """
         wagers = db.get_wagers_from_game_id(game_id, WagerResult.INPROGRESS)
+        if not wagers:
+            return
         teams = wagers[0][6:8]
         captains = [await get_nick_from_discord_id(team.split()[0]) for team in teams]
+        captains_str = " and ".join(captains)
+        transfers = []
+        wager_results = []
+        messages = []
         for wager in wagers:
             wager_id = wager[0]
             user_id = wager[1]
             amount = wager[3]
             nick = wager[4]
-            transfer = (bot_user_id, user_id, amount)
-            db.create_transfer(transfer)
-            db.wager_result(wager_id, WagerResult.CANCELLED)
-            msg = (f'Hi {nick}. Your bet on the game captained by {" and ".join(captains)} was cancelled '
+            transfers.append((bot_user_id, user_id, amount))
+            wager_results.append((WagerResult.CANCELLED, wager_id))
+            msg = (f'Hi {nick}. Your bet on the game captained by {captains_str} was cancelled '
                    f'due to {reason}. Your bet of {amount} shazbucks has been returned to you.')
-            await send_dm(user_id, msg)
+            messages.append((user_id, msg))
+        db.settle_wagers(transfers, wager_results)
+        await send_dms(messages)
 
     @bot.event
     async def on_ready():
@@ -268,6 +444,12 @@ def start_bot(db, ts, logger):
         for guild in bot.guilds:
             logger.info(f'\t\t{guild.name}(id: {guild.id})')
 
+    @bot.event
+    async def on_member_update(_before, after):
+        # Drop cached entries of a member whose nick or roles changed
+        for key in [k for k, (_, member) in member_cache.items() if member.id == after.id]:
+            del member_cache[key]
+
     def in_channel(channel_id):
         def predicate(ctx):
             return ctx.message.channel.id == channel_id
@@ -280,32 +462,26 @@ def start_bot(db, ts, logger):
         success = False
         discord_id = ctx.author.id
         nick = ctx.author.name
-        data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
-        if not data:
+        with db.transaction():
             user_id = db.create_user((discord_id, nick, 0, 0))
-            if user_id == 0 or db.create_transfer((bot_user_id, user_id, INIT_BAL)) == 0:
-                await ctx.author.create_dm()
-                await ctx.author.dm_channel.send(
-                    f'Hi {ctx.author.name}, something went wrong creating your account. Please try again later or '
-                    f'contact an admin.'
-                )
-                logger.error(
-                    f'Something went wrong creating an account for {ctx.author.name}. User id {user_id}.'
-                )
-            else:
-                msg = (
-                    f'Hi {ctx.author.name}, welcome! You have received an initial balance of {INIT_BAL} '
-                    f'shazbucks, bet wisely! These are the basic commands:\n'
-                    f'- !balance - to check your balance\n'
-                    f'- !show - to show games that are currently open for betting\n'
-                    f'- !mute - to mute the bot\'s DMs\n'
-                    f'- !bet <captain> <amount> - to bet <amount> on the team captained by <captain>\n'
-                    f'Instead of <captain> you can also use 1,2, Red or Blue to select a team '
-                    f'from the last picked game'
-                )
-                await send_dm(user_id, msg)
-                success = True
+            if user_id:
+                db.create_transfer((bot_user_id, user_id, INIT_BAL))
+        if user_id:
+            dm_settings[user_id] = (discord_id, 0)
+            msg = (
+                f'Hi {ctx.author.name}, welcome! You have received an initial balance of {INIT_BAL} '
+                f'shazbucks, bet wisely! These are the basic commands:\n'
+                f'- !balance - to check your balance\n'
+                f'- !show - to show games that are currently open for betting\n'
+                f'- !mute - to mute the bot\'s DMs\n'
+                f'- !bet <captain> <amount> - to bet <amount> on the team captained by <captain>\n'
+                f'Instead of <captain> you can also use 1,2, Red or Blue to select a team '
+                f'from the last picked game'
+            )
+            await send_dm(user_id, msg)
+            success = True
         else:
+            data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
             msg = f'Hi {data[1]}, you already have an account!'
             await send_dm(data[0], msg)
         await ctx.message.add_reaction(REACTIONS[success])
@@ -317,11 +493,9 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('nick', 'balance'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {data[0]}, your balance is {data[1]} shazbucks!')
+            await ctx.author.send(f'Hi {data[0]}, your balance is {data[1]} shazbucks!')
             success = True
         await ctx.message.add_reaction(REACTIONS[success])
 
@@ -332,8 +506,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick', 'balance'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             sender_id: int = data[0]
             nick: str = data[1]
@@ -382,8 +555,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick', 'balance'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             nick: str = data[1]
@@ -436,24 +608,20 @@ def start_bot(db, ts, logger):
                             winner = team_id_str
                         time_since_pick = games[-1][6]
                     else:
-                        for game in games:
-                            team_id_strs = game[1:3]
-                            queue = game[3]
-                            if queue in ('NA', 'EU', 'AU', 'TestBranch'):
-                                capt_ids_strs = [team_id_str.split()[0] for team_id_str in team_id_strs]
-                                capt_nicks = [(await get_nick_from_discord_id(did)) for did in capt_ids_strs]
-                            else:
-                                capt_nicks = team_id_strs
-                            if caseless_equal(winner, capt_nicks[0]):
-                                game_id = game[0]
-                                prediction += GameStatus.TEAM1
-                                time_since_pick = game[6]
-                                winner = capt_nicks[0]
-                            elif caseless_equal(winner, capt_nicks[1]):
-                                game_id = game[0]
-                                prediction += GameStatus.TEAM2
-                                time_since_pick = game[6]
-                                winner = capt_nicks[1]
+                        # Map the captains of all running games to their game and team, the newest game goes last
+                        capt_nicks_per_game = await asyncio.gather(*(get_capt_nicks(game[1:3], game[3])
+                                                                     for game in games))
+                        captains = {}
+                        for game, capt_nicks in zip(games, capt_nicks_per_game):
+                            captains[normalize_caseless(capt_nicks[0])] = (game, GameStatus.TEAM1, capt_nicks[0])
+                            captains[normalize_caseless(capt_nicks[1])] = (game, GameStatus.TEAM2, capt_nicks[1])
+                        captain = captains.get(normalize_caseless(winner))
+                        if captain:
+                            (game, team, winner) = captain
+                            game_id = game[0]
+                            prediction += team
+                            time_since_pick = game[6]
+                            bet_window = game[7]
                     if prediction == 0:
                         if game_id == 0:
                             msg = (f'Hi {nick}, could not find a game to bet on {winner}. Please check the spelling, '
@@ -503,12 +671,12 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'mute_dm'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             mute_dm: int = (db.get_user_data(user_id, ('mute_dm',))[0] + 1) % 2
             db.set_user_data(user_id, ('mute_dm',), (mute_dm,))
+            dm_settings[user_id] = (discord_id, mute_dm)
             msg = f'Hi {ctx.author.name}, direct messages have been unmuted!'
             await send_dm(user_id, msg)
             success = True
@@ -521,8 +689,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             show_str = ''
             # Add MOTDs
@@ -531,8 +698,7 @@ def start_bot(db, ts, logger):
                 for motd in motds:
                     show_str += f'MOTD: {motd[5]}\n'
             # Find running games
-            games = db.get_games_by_status(GameStatus.PICKING)
-            games += db.get_games_by_status(GameStatus.INPROGRESS)
+            games = db.get_games_by_status(GameStatus.PICKING, GameStatus.INPROGRESS)
             if not games:
                 show_str += f'No games are currently walking or running'
             else:
@@ -579,8 +745,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             nick: str = data[1]
@@ -614,8 +779,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             nick: str = data[1]
@@ -649,8 +813,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             nick: str = data[1]
@@ -749,20 +912,17 @@ def start_bot(db, ts, logger):
             repo.remotes.origin.pull()
             if current_commit == repo.head.commit:
                 logger.info('No change or ahead of repo.')
-                await ctx.author.create_dm()
-                await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, no update available!')
+                await ctx.author.send(f'Hi {ctx.author.name}, no update available!')
 
             else:
                 logger.info('Updated successfully.')
-                await ctx.author.create_dm()
-                await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, updated successfully!')
+                await ctx.author.send(f'Hi {ctx.author.name}, updated successfully!')
             success = True
         except git.GitCommandError as e:
             logger.error('Git command did not complete correctly:')
             for line in str(e).split('\n'):
                 logger.error(f'\t{line}')
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, update did not complete successfully!')
+            await ctx.author.send(f'Hi {ctx.author.name}, update did not complete successfully!')
         await ctx.message.add_reaction(REACTIONS[success])
 
     @bot.command(name='changelog', help='Show changelog')
@@ -774,20 +934,18 @@ def start_bot(db, ts, logger):
         repo = git.Repo('./')
         try:
             log = repo.heads.master.log()
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, these are the latest 5 commits:')
+            await ctx.author.send(f'Hi {ctx.author.name}, these are the latest 5 commits:')
             for entry in log[-5:]:
                 commit = repo.commit(entry.newhexsha)
                 entry_string = (f'{commit.authored_datetime} {entry.newhexsha} {commit.author.name}:\n'
                                 f'{commit.message.rstrip()}')
-                await ctx.author.dm_channel.send(entry_string)
+                await ctx.author.send(entry_string)
             success = True
         except git.GitCommandError as e:
             logger.error('Git command did not complete correctly:')
             for line in str(e).split('\n'):
                 logger.error(f'\t{line}')
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, error showing changelog!')
+            await ctx.author.send(f'Hi {ctx.author.name}, error showing changelog!')
         await ctx.message.add_reaction(REACTIONS[success])
 
     @bot.command(name='change_game', help='Change the outcome of a game')
@@ -798,8 +956,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             change_nick: str = data[1]
@@ -817,6 +974,7 @@ def start_bot(db, ts, logger):
                     capt_nicks = [await get_nick_from_discord_id(did) for did in capt_ids_strs]
                 else:
                     capt_nicks = capt_ids_strs
+                capt_nicks_str = " and ".join(capt_nicks)
                 old_status = game[4]
                 new_status = None
                 if result in ['1', 'Red', 'red', 'Team1', 'team1', capt_nicks[0]]:
@@ -844,30 +1002,26 @@ def start_bot(db, ts, logger):
                         await send_dm(user_id, msg)
                     else:
                         # Initialize parameters
-                        total_amounts = {GameStatus.TEAM1.name: 0, GameStatus.TEAM2.name: 0, GameStatus.TIED.name: 0}
+                        total_amounts = {GameStatus.TEAM1: 0, GameStatus.TEAM2: 0, GameStatus.TIED: 0}
                         winners = []
-                        wagers = db.get_wagers_from_game_id(game_id, WagerResult.INPROGRESS)
-                        wagers += db.get_wagers_from_game_id(game_id, WagerResult.WON)
-                        wagers += db.get_wagers_from_game_id(game_id, WagerResult.LOST)
-                        wagers += db.get_wagers_from_game_id(game_id, WagerResult.CANCELLEDNOWINNERS)
+                        wagers = db.get_wagers_from_game_id(game_id, WagerResult.INPROGRESS, WagerResult.WON,
+                                                            WagerResult.LOST, WagerResult.CANCELLEDNOWINNERS)
                         # Calculate the total amounts bet on each outcome
                         for wager in wagers:
                             prediction = wager[2]
                             amount = wager[3]
-                            total_amounts[prediction.name] += amount
+                            total_amounts[prediction] += amount
                         total_amount = sum(total_amounts.values())
                         if old_status != GameStatus.INPROGRESS:
                             # Calculate the payout ratio (0 if no bets on winning outcome)
                             ratio = 0
-                            if old_status == GameStatus.TEAM1 and total_amounts[GameStatus.TEAM1.name] > 0:
-                                ratio = total_amount / total_amounts[GameStatus.TEAM1.name]
-                            elif old_status == GameStatus.TEAM2 and total_amounts[GameStatus.TEAM2.name] > 0:
-                                ratio = total_amount / total_amounts[GameStatus.TEAM2.name]
-                            elif old_status == GameStatus.TIED and total_amounts[GameStatus.TIED.name] > 0:
-                                ratio = total_amount / total_amounts[GameStatus.TIED.name]
-                            # Set the status of the game back to INPROGRESS
-                            db.finish_game(game_id, GameStatus.INPROGRESS)
+                            if total_amounts.get(old_status, 0) > 0:
+                                ratio = total_amount / total_amounts[old_status]
                             # Claw back previous payout
+                            transfers = []
+                            wager_results = []
+                            messages = []
+                            winner_ids = []
                             for wager in wagers:
                                 wager_id = wager[0]
                                 user_id = wager[1]
@@ -876,32 +1030,34 @@ def start_bot(db, ts, logger):
                                 nick: str = wager[4]
                                 discord_id: int = wager[5]
                                 if ratio == 0:
-                                    transfer = (user_id, bot_user_id, amount)
-                                    db.create_transfer(transfer)
-                                    db.wager_result(wager_id, WagerResult.INPROGRESS)
+                                    transfers.append((user_id, bot_user_id, amount))
+                                    wager_results.append((WagerResult.INPROGRESS, wager_id))
                                     msg = (f'Hi {nick}. The result of game {game_id}, between '
-                                           f'{" and ".join(capt_nicks)}, was changed. Your previously returned bet of '
+                                           f'{capt_nicks_str}, was changed. Your previously returned bet of '
                                            f'{amount} shazbucks has been placed again.')
-                                    await send_dm(user_id, msg)
+                                    messages.append((user_id, msg))
                                 elif prediction == old_status:
-                                    win_amount = round(amount * ratio)
-                                    if prediction == GameStatus.TIED:
-                                        win_amount = win_amount * TIE_PAYOUT_SCALE
-                                    transfer = (user_id, bot_user_id, win_amount)
-                                    db.create_transfer(transfer)
-                                    db.wager_result(wager_id, WagerResult.INPROGRESS)
+                                    win_amount = calculate_win_amount(amount, prediction, total_amount,
+                                                                      total_amounts[old_status])
+                                    transfers.append((user_id, bot_user_id, win_amount))
+                                    wager_results.append((WagerResult.INPROGRESS, wager_id))
                                     msg = (f'Hi {nick}. The result of game {game_id}, between '
-                                           f'{" and ".join(capt_nicks)}, was changed. Your previous payout of '
+                                           f'{capt_nicks_str}, was changed. Your previous payout of '
                                            f'{win_amount} shazbucks has been clawed back.')
-                                    await send_dm(user_id, msg)
-                                    winner = await get_nick_from_discord_id(str(discord_id))
-                                    winners.append((winner, win_amount))
+                                    messages.append((user_id, msg))
+                                    winner_ids.append((discord_id, win_amount))
                                 else:
-                                    db.wager_result(wager_id, WagerResult.INPROGRESS)
+                                    wager_results.append((WagerResult.INPROGRESS, wager_id))
                                     msg = (f'Hi {nick}. The result of game {game_id}, between '
-                                           f'{" and ".join(capt_nicks)}, was changed. Your previously lost bet of '
+                                           f'{capt_nicks_str}, was changed. Your previously lost bet of '
                                            f'{amount} shazbucks has been placed again.')
-                                    await send_dm(user_id, msg)
+                                    messages.append((user_id, msg))
+                            # Set the status of the game back to INPROGRESS together with the claw back
+                            with db.transaction():
+                                db.finish_game(game_id, GameStatus.INPROGRESS)
+                                db.settle_wagers(transfers, wager_results)
+                            await send_dms(messages)
+                            winners = await get_winner_nicks(winner_ids)
                             result_msg = ''
                             if (old_status == GameStatus.TEAM1 or
                                     old_status == GameStatus.TEAM2 or
@@ -909,7 +1065,7 @@ def start_bot(db, ts, logger):
                                 if ratio == 0:
                                     if total_amount > 0:
                                         result_msg = (f'The result of game {game_id}, between '
-                                                      f'{" and ".join(capt_nicks)}, was changed. All wagers have been '
+                                                      f'{capt_nicks_str}, was changed. All wagers have been '
                                                       f'placed again.')
                                 else:
                                     verb = "was" if len(winners) == 1 else "were"
@@ -917,13 +1073,14 @@ def start_bot(db, ts, logger):
                                                              (winner, win_amount) in winners])
                                     payout = sum([win_amount for (winner, win_amount) in winners])
                                     result_msg = (f'The result of game {game_id}, between '
-                                                  f'{" and ".join(capt_nicks)}, was changed. The previous winnings of '
+                                                  f'{capt_nicks_str}, was changed. The previous winnings of '
                                                   f'{winners_str} for a total of {payout} shazbucks {verb} clawed '
                                                   f'back.')
                             if result_msg:
                                 await ctx.send(result_msg)
                         # Set the status of the game to the new result
                         db.finish_game(game_id, new_status)
+                        game_ratings.pop(game_id, None)
                         # Payout based on new result
                         total_amounts, winners = await resolve_wagers(game_id, new_status, capt_nicks, True)
                         total_amount = sum(total_amounts.values())
@@ -934,14 +1091,14 @@ def start_bot(db, ts, logger):
                             if total_amount == 0:
                                 logger.info(f'Game {game_id} changed by {change_nick} to result: {new_status.name}, '
                                             f'but the game had no bets or all bets were on a single outcome.')
-                            elif total_amounts[new_status.name] == 0:
-                                result_msg = (f'The result of game {game_id}, between {" and ".join(capt_nicks)}, '
+                            elif total_amounts[new_status] == 0:
+                                result_msg = (f'The result of game {game_id}, between {capt_nicks_str}, '
                                               f'was changed. There were no bets on the correct outcome. '
                                               f'All wagers have been returned.')
                                 logger.info(f'Game {game_id} was changed by {change_nick} to: {new_status.name}, '
                                             f'but the game had no bets on that outcome. All wagers have been returned.')
-                            elif total_amounts[new_status.name] == total_amount:
-                                result_msg = (f'The result of game {game_id}, between {" and ".join(capt_nicks)}, '
+                            elif total_amounts[new_status] == total_amount:
+                                result_msg = (f'The result of game {game_id}, between {capt_nicks_str}, '
                                               f'was changed. There were only bets on the correct outcome. '
                                               f'All wagers have been returned.')
                                 logger.info(f'Game {game_id} was changed by {change_nick} to: {new_status.name}, but '
@@ -951,13 +1108,13 @@ def start_bot(db, ts, logger):
                                 winners_str = ', '.join([f'{winner}({win_amount})' for
                                                          (winner, win_amount) in winners])
                                 payout = sum([win_amount for (winner, win_amount) in winners])
-                                result_msg = (f'The result of game {game_id}, between {" and ".join(capt_nicks)}, '
+                                result_msg = (f'The result of game {game_id}, between {capt_nicks_str}, '
                                               f'was changed. {winners_str} {verb} paid out a total of {payout} '
                                               f'shazbucks.')
                                 logger.info(f'Game {game_id} was changed by {change_nick} to: {new_status.name}. '
                                             f'{winners_str} {verb} paid out a total of {payout} shazbucks.')
                         elif new_status == GameStatus.CANCELLED:
-                            result_msg = (f'Game {game_id}, between {" and ".join(capt_nicks)}, was cancelled. '
+                            result_msg = (f'Game {game_id}, between {capt_nicks_str}, was cancelled. '
                                           f'All wagers have been returned.')
                             logger.info(f'Game {game_id} was changed by {change_nick} to: {new_status.name}, '
                                         f'All wagers have been returned.')
@@ -976,8 +1133,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             nick: str = data[1]
@@ -990,8 +1146,9 @@ def start_bot(db, ts, logger):
             else:
                 teams = (outcome1, outcome2)
                 game = (description,) + teams + (duration.to_seconds,)
-                game_id = db.create_game(game)
-                db.pick_game(game_id, teams)
+                with db.transaction():
+                    game_id = db.create_game(game)
+                    db.pick_game(game_id, teams)
                 success = True
         await ctx.message.add_reaction(REACTIONS[success])
 
@@ -1003,8 +1160,7 @@ def start_bot(db, ts, logger):
         discord_id = ctx.author.id
         data = db.get_user_data_by_discord_id(discord_id, ('id', 'nick'))
         if not data:
-            await ctx.author.create_dm()
-            await ctx.author.dm_channel.send(f'Hi {ctx.author.name}, you do not have an account yet!')
+            await ctx.author.send(f'Hi {ctx.author.name}, you do not have an account yet!')
         else:
             user_id: int = data[0]
             nick: str = data[1]
@@ -1046,14 +1202,14 @@ def start_bot(db, ts, logger):
                             if sum(total_amounts.values()) == 0:
                                 logger.info(f'Custom Game {game_id} ended by {nick} with result: {status.name}, '
                                             f'but the game had no bets. All wagers have been returned.')
-                            elif total_amounts[status.name] == 0:
+                            elif total_amounts[status] == 0:
                                 result_msg = (f'The game {game_id}, with possible outcomes {" and ".join(outcomes)} '
                                               f' or a tie finished. The game had no bets on the winning outcome. All '
                                               f'wagers have been returned.')
                                 logger.info(f'Custom Game {game_id} ended by {nick} with result: {status.name}, '
                                             f'but the game had no bets on that outcome. All wagers have been '
                                             f'returned.')
-                            elif total_amounts[status.name] == sum(total_amounts.values()):
+                            elif total_amounts[status] == sum(total_amounts.values()):
                                 result_msg = (f'The game {game_id}, with possible outcomes {" and ".join(outcomes)} '
                                               f' or a tie finished. The game only had bets on the winning outcome. '
                                               f'All wagers have been returned.')
@@ -1154,8 +1310,7 @@ def start_bot(db, ts, logger):
                              f'on {datetime.utcfromtimestamp(start_time)} and '
                              f'to expire on {datetime.utcfromtimestamp(end_time)}:\n{motd_message}')
                 await asyncio.sleep(DM_TIME_TO_WAIT)
-                await requestor.create_dm()
-                await requestor.dm_channel.send(motd_info)
+                await requestor.send(motd_info)
             success = True
         await ctx.message.add_reaction(REACTIONS[success])
 
@@ -1201,7 +1356,8 @@ def start_bot(db, ts, logger):
         game = (queue,) + team_id_strs + (DEFAULT_BET_WINDOW.to_seconds,)
         game_id = db.create_game(game)
         logger.info(f'Game {game_id} created in the {queue} queue: {" ".join(player_nicks)}')
-        best_team1_ids, best_team2_ids, best_chance_to_draw = suggest_even_teams(db, player_ids)
+        player_ratings = get_game_ratings(game_id, player_ids)
+        best_team1_ids, best_team2_ids, best_chance_to_draw = suggest_even_teams(player_ratings, player_ids)
         team1_str = '<@!' + '>, <@!'.join([str(i) for i in best_team1_ids]) + '>'
         team2_str = '<@!' + '>, <@!'.join([str(i) for i in best_team2_ids]) + '>'
         result_msg = f'Suggested teams: {team1_str} versus {team2_str} ({best_chance_to_draw:.1%} chance to draw).'
@@ -1227,8 +1383,7 @@ def start_bot(db, ts, logger):
                 else:
                     logger.error(f'Could not find discord id for player {nick}')
             team_id_strs += (" ".join(id_strs),)
-        data = db.get_games_by_status(GameStatus.PICKING)
-        data += db.get_games_by_status(GameStatus.INPROGRESS)
+        data = db.get_games_by_status(GameStatus.PICKING, GameStatus.INPROGRESS)
         games = []
         for game in data:
             if game[3] == queue:
@@ -1292,7 +1447,8 @@ def start_bot(db, ts, logger):
         # Estimate chances
         team1_ids = [int(i) for i in team_id_strs[0].split()]
         team2_ids = [int(i) for i in team_id_strs[1].split()]
-        team1_win_chance = calculate_win_chance(db, (team1_ids, team2_ids))
+        player_ratings = get_game_ratings(game_id, team1_ids + team2_ids)
+        team1_win_chance = calculate_win_chance(player_ratings, (team1_ids, team2_ids))
         if team1_win_chance > 0:
             result_msg = (f'Teams picked, prediction: Team 1 ({team1_win_chance:.1%}), Team 2 '
                           f'({(1 - team1_win_chance):.1%}).')
@@ -1312,6 +1468,7 @@ def start_bot(db, ts, logger):
         else:
             game_id = games[0][0]
             db.cancel_game(game_id)
+            game_ratings.pop(game_id, None)
             logger.info(f'Game {game_id} cancelled, hopefully it was the right one!')
             success = True
         await message.add_reaction(REACTIONS[success])
@@ -1353,59 +1510,39 @@ def start_bot(db, ts, logger):
                 logger.error(f'Game finished with a win for {winner_nick} in {queue} queue, but no game with '
                              f'InProgress status and that captain in that queue.')
         if games:
+            game = games[0]
             if len(games) > 1:
-                games.sort(key=lambda x: abs(x[5] / 60 - duration))
+                game = min(games, key=lambda x: abs(x[5] / 60 - duration))
                 logger.info('Game finished but multiple games match:')
-            game_id = games[0][0]
-            team_id_strs = games[0][1:3]
+            game_id = game[0]
+            team_id_strs = game[1:3]
             # Create a list of discord members per team
             teams = ()
             for team_str in team_id_strs:
-                team = []
-                for discord_id_str in team_str.split():
-                    if discord_id_str.isdigit():
-                        player = await fetch_member(int(discord_id_str))
-                        if player:
-                            team.append(player)
+                discord_ids = [int(discord_id_str) for discord_id_str in team_str.split() if discord_id_str.isdigit()]
+                members = await asyncio.gather(*(fetch_member(discord_id) for discord_id in discord_ids))
+                team = [player for player in members if player]
                 teams += (team,)
             # Cache captain info
             capt_ids = [teams[0][0].id, teams[1][0].id]
             capt_nicks = [teams[0][0].display_name, teams[1][0].display_name]
             # Establish result if not tied
             if game_result != GameStatus.TIED:
-                if winner_id == capt_ids[0]:
-                    game_result = GameStatus.TEAM1
-                elif winner_id == capt_ids[1]:
-                    game_result = GameStatus.TEAM2
-                else:
-                    game_result = 0
+                game_result = {capt_ids[0]: GameStatus.TEAM1, capt_ids[1]: GameStatus.TEAM2}.get(winner_id, 0)
+                if not game_result:
                     logger.error(f'Winner {winner_nick} ({winner_id}) not found in game {game_id}: {capt_nicks[0]} '
                                  f'versus {capt_nicks[1]}')
             # Update the database, resolve wagers, pay the participants and update trueskills
             if game_result:
-                db.finish_game(game_id, game_result)
-                total_amounts, winners = await resolve_wagers(game_id, game_result, capt_nicks)
-                await pay_players(teams)
-                team_ratings = ()
-                for team in teams:
-                    team_rating = []
-                    for player in team:
-                        data = db.get_trueskill_rating(player.id)
-                        if data:
-                            team_rating.append(Rating(data[0], data[1]))
-                        else:
-                            team_rating.append(Rating())
-                    team_ratings += (team_rating,)
-                ranks = [0, 0]
-                if game_result == GameStatus.TEAM1:
-                    ranks = [0, 1]
-                elif game_result == GameStatus.TEAM2:
-                    ranks = [1, 0]
-                new_team_ratings = rate([team_ratings[0], team_ratings[1]], ranks)
-                for team_idx, team in enumerate(teams):
-                    for player_idx, player in enumerate(team):
-                        rating: Rating = new_team_ratings[team_idx][player_idx]
-                        db.new_trueskill_rating(player.id, game_id, rating)
+                # Record the result, payouts and ratings in a single transaction before notifying anyone
+                with db.transaction():
+                    db.finish_game(game_id, game_result)
+                    total_amounts, winner_ids, messages = settle_game_wagers(game_id, game_result, capt_nicks)
+                    messages += pay_players(teams, capt_nicks)
+                    update_trueskill_ratings(game_id, game_result, teams)
+                game_ratings.pop(game_id, None)
+                await send_dms(messages)
+                winners = await get_winner_nicks(winner_ids)
         # Send summary message to the channel, unless nobody placed a bet
         result_msg = ''
         if game_result is None:
@@ -1417,11 +1554,11 @@ def start_bot(db, ts, logger):
               game_result == GameStatus.TIED):
             if sum(total_amounts.values()) == 0:
                 logger.info(f'Game {game_id} finished with result: {game_result.name}, but the game had no bets.')
-            elif total_amounts[game_result.name] == 0:
+            elif total_amounts[game_result] == 0:
                 result_msg = 'The game had no bets on the correct outcome. All wagers have been returned.'
                 logger.info(f'Game {game_id} finished with result: {game_result.name}, but the game had no bets '
                             f'on that outcome. All wagers have been returned.')
-            elif total_amounts[game_result.name] == sum(total_amounts.values()):
+            elif total_amounts[game_result] == sum(total_amounts.values()):
                 result_msg = 'The game only had bets on the correct outcome. All wagers have been returned.'
                 logger.info(f'Game {game_id} finished with result: {game_result.name}, but the game only had bets '
                             f'on that outcome. All wagers have been returned.')
@@ -1447,14 +1584,42 @@ def start_bot(db, ts, logger):
         :return: a dictionary with the total amounts bet on each team and a dictionary with the amount won by each
             winner
         """
+        total_amounts, winner_ids, messages = settle_game_wagers(game_id, game_result, capt_nicks, change)
+        await send_dms(messages)
+        winners = await get_winner_nicks(winner_ids)
+        # Return the total amount bet on each team and the winners and how much they won
+        return total_amounts, winners
+
+    async def get_winner_nicks(winner_ids) -> List[Tuple[str, int]]:
+        """Look up the nicks of the winners of a game
+
+        :param List[Tuple[int, int]] winner_ids: List of the discord id of each winner and the amount won
+        :return: List of the nick of each winner and the amount won
+        """
+        winner_nicks = await asyncio.gather(*(get_nick_from_discord_id(str(discord_id)) for
+                                              (discord_id, win_amount) in winner_ids))
+        return [(winner, win_amount) for (winner, (discord_id, win_amount)) in zip(winner_nicks, winner_ids)]
+
+    def settle_game_wagers(game_id, game_result, capt_nicks, change=False) -> Tuple[dict, List[Tuple[int, int]],
+                                                                                     List[Tuple[int, str]]]:
+        """Pay out the wagers placed on a game based on its outcome, without notifying the bettors
+
+        :param int game_id: id of the game
+        :param int game_result: Result of the game
+        :param List[str] capt_nicks: List of captain nicks
+        :param bool change: Boolean indicating whether the result of the game is being changed
+        :return: a dictionary with the total amounts bet on each team, a list with the discord id of each winner and the
+            amount won and a list of the messages to send to the bettors
+        """
         # Initialize parameters
-        total_amounts = {GameStatus.TEAM1.name: 0, GameStatus.TEAM2.name: 0, GameStatus.TIED.name: 0}
-        winners = []
+        total_amounts = {GameStatus.TEAM1: 0, GameStatus.TEAM2: 0, GameStatus.TIED: 0}
         # Find wagers on this game
         wagers = db.get_wagers_from_game_id(game_id, WagerResult.INPROGRESS)
+        if not wagers:
+            return total_amounts, [], []
         # Calculate the total amounts bet on each outcome
         for wager in wagers:
-            prediction = wager[2].name
+            prediction = wager[2]
             amount = wager[3]
             total_amounts[prediction] += amount
         # Calculate the payout ratio (0 if no bets on winning outcome, 1.0 if only bets on winning outcome)
@@ -1463,13 +1628,14 @@ def start_bot(db, ts, logger):
             ratio = -1
         else:
             ratio = 0
-            if game_result == GameStatus.TEAM1 and total_amounts[GameStatus.TEAM1.name] > 0:
-                ratio = total_amount / total_amounts[GameStatus.TEAM1.name]
-            elif game_result == GameStatus.TEAM2 and total_amounts[GameStatus.TEAM2.name] > 0:
-                ratio = total_amount / total_amounts[GameStatus.TEAM2.name]
-            elif game_result == GameStatus.TIED and total_amounts[GameStatus.TIED.name] > 0:
-                ratio = total_amount / total_amounts[GameStatus.TIED.name]
+            if total_amounts.get(game_result, 0) > 0:
+                ratio = total_amount / total_amounts[game_result]
         # Resolve each individual bet
+        capt_nicks_str = " and ".join(capt_nicks)
+        transfers = []
+        wager_results = []
+        messages = []
+        winner_ids = []
         for wager in wagers:
             wager_id = wager[0]
             user_id = wager[1]
@@ -1478,102 +1644,129 @@ def start_bot(db, ts, logger):
             nick = wager[4]
             discord_id = wager[5]
             if ratio == -1:
-                transfer = (bot_user_id, user_id, amount)
-                db.create_transfer(transfer)
-                db.wager_result(wager_id, WagerResult.CANCELLED)
+                transfers.append((bot_user_id, user_id, amount))
+                wager_results.append((WagerResult.CANCELLED, wager_id))
                 if change:
-                    msg = (f'Hi {nick}. The game between {" and ".join(capt_nicks)} was changed: the game was '
+                    msg = (f'Hi {nick}. The game between {capt_nicks_str} was changed: the game was '
                            f'cancelled. Your bet of {amount} shazbucks has been returned to you.')
                 else:
-                    msg = (f'Hi {nick}. The game between {" and ".join(capt_nicks)} was cancelled. Your bet of '
+                    msg = (f'Hi {nick}. The game between {capt_nicks_str} was cancelled. Your bet of '
                            f'{amount} shazbucks has been returned to you.')
-                await send_dm(user_id, msg)
+                messages.append((user_id, msg))
             elif ratio == 0:
-                transfer = (bot_user_id, user_id, amount)
-                db.create_transfer(transfer)
-                db.wager_result(wager_id, WagerResult.CANCELLEDNOWINNERS)
+                transfers.append((bot_user_id, user_id, amount))
+                wager_results.append((WagerResult.CANCELLEDNOWINNERS, wager_id))
                 if change:
-                    msg = (f'Hi {nick}. The game between {" and ".join(capt_nicks)} was changed. Nobody predicted '
+                    msg = (f'Hi {nick}. The game between {capt_nicks_str} was changed. Nobody predicted '
                            f'the correct outcome. Your bet of {amount} shazbucks has been returned to you.')
                 else:
                     msg = (f'Hi {nick}. Nobody predicted the correct outcome of the game between '
-                           f'{" and ".join(capt_nicks)}. Your bet of {amount} shazbucks has been returned to you.')
-                await send_dm(user_id, msg)
+                           f'{capt_nicks_str}. Your bet of {amount} shazbucks has been returned to you.')
+                messages.append((user_id, msg))
             elif ratio == 1.0:
-                transfer = (bot_user_id, user_id, amount)
-                db.create_transfer(transfer)
-                db.wager_result(wager_id, WagerResult.CANCELLEDONESIDED)
+                transfers.append((bot_user_id, user_id, amount))
+                wager_results.append((WagerResult.CANCELLEDONESIDED, wager_id))
                 if change:
-                    msg = (f'Hi {nick}. The game between {" and ".join(capt_nicks)} was changed. Nobody took '
+                    msg = (f'Hi {nick}. The game between {capt_nicks_str} was changed. Nobody took '
                            f'your bet. Your bet of {amount} shazbucks has been returned to you.')
                 else:
-                    msg = (f'Hi {nick}. Nobody took your bet on the game between {" and ".join(capt_nicks)}. '
+                    msg = (f'Hi {nick}. Nobody took your bet on the game between {capt_nicks_str}. '
                            f'Your bet of {amount} shazbucks has been returned to you.')
-                await send_dm(user_id, msg)
+                messages.append((user_id, msg))
             elif prediction == game_result:
-                win_amount = round(amount * ratio)
-                if prediction == GameStatus.TIED:
-                    win_amount = win_amount * TIE_PAYOUT_SCALE
-                transfer = (bot_user_id, user_id, win_amount)
-                db.create_transfer(transfer)
-                db.wager_result(wager_id, WagerResult.WON)
+                win_amount = calculate_win_amount(amount, prediction, total_amount, total_amounts[game_result])
+                transfers.append((bot_user_id, user_id, win_amount))
+                wager_results.append((WagerResult.WON, wager_id))
                 if change:
-                    msg = (f'Hi {nick}. The game between {" and ".join(capt_nicks)} was changed. You correctly '
+                    msg = (f'Hi {nick}. The game between {capt_nicks_str} was changed. You correctly '
                            f'predicted the new result and have won {win_amount} shazbucks.')
                 else:
                     msg = (f'Hi {nick}. You correctly predicted the game between '
-                           f'{" and ".join(capt_nicks)}. You have won {win_amount} shazbucks.')
-                await send_dm(user_id, msg)
-                winner = await get_nick_from_discord_id(str(discord_id))
-                winners.append((winner, win_amount))
+                           f'{capt_nicks_str}. You have won {win_amount} shazbucks.')
+                messages.append((user_id, msg))
+                winner_ids.append((discord_id, win_amount))
             else:
-                db.wager_result(wager_id, WagerResult.LOST)
+                wager_results.append((WagerResult.LOST, wager_id))
                 if change:
-                    msg = (f'Hi {nick}. The game between {" and ".join(capt_nicks)} was changed. You did not '
+                    msg = (f'Hi {nick}. The game between {capt_nicks_str} was changed. You did not '
                            f'predict the new result correctly and have lost your bet of {amount} shazbucks.')
                 else:
                     msg = (f'Hi {nick}. You lost your bet of {amount} shazbucks on the game between '
-                           f'{" and ".join(capt_nicks)}.')
-                await send_dm(user_id, msg)
-        # Return the total amount bet on each team and the winners and how much they won
-        return total_amounts, winners
+                           f'{capt_nicks_str}.')
+                messages.append((user_id, msg))
+        db.settle_wagers(transfers, wager_results)
+        return total_amounts, winner_ids, messages
 
-    async def pay_players(teams):
-        """Pay the players for participating in a PuG
+    def pay_players(teams, capt_nicks) -> List[Tuple[int, str]]:
+        """Pay the players for participating in a PuG, without notifying the players
 
         :param Tuple[List[discord.Member], List[discord.Member]] teams: Tuple of List per team of discord.Member
+        :param List[str] capt_nicks: List of captain nicks
+        :return: List of the messages to send to the players
         """
-        # Cache captain info
-        capt_nicks = (teams[0][0].display_name, teams[1][0].display_name)
+        capt_nicks_str = " and ".join(capt_nicks)
+        users = db.get_users_data_by_discord_ids([player.id for team in teams for player in team], ('id', 'nick'))
+        transfers = []
+        messages = []
         for idx, team in enumerate(teams):
             captain = True
             for player in team:
-                user = db.get_user_data_by_discord_id(player.id, ('id', 'nick'))
+                user = users.get(player.id)
                 if user:
                     user_id: int = user[0]
                     nick: str = user[1]
                     if captain:
                         captain = False
                         index = 1 - idx
-                        transfer = (bot_user_id, user_id, BUCKS_PER_PUG * 2)
-                        db.create_transfer(transfer)
+                        transfers.append((bot_user_id, user_id, BUCKS_PER_PUG * 2))
                         msg = (f'Hi {nick}. You captained a game against {capt_nicks[index]}. For '
                                f'your efforts you have been rewarded {BUCKS_PER_PUG * 2} shazbucks')
-                        await send_dm(user_id, msg)
+                        messages.append((user_id, msg))
                     else:
-                        transfer = (bot_user_id, user_id, BUCKS_PER_PUG)
-                        db.create_transfer(transfer)
-                        msg = (f'Hi {nick}. You played a game captained by {" and ".join(capt_nicks)}. '
+                        transfers.append((bot_user_id, user_id, BUCKS_PER_PUG))
+                        msg = (f'Hi {nick}. You played a game captained by {capt_nicks_str}. '
                                f'For your efforts you have been rewarded {BUCKS_PER_PUG} shazbucks')
-                        await send_dm(user_id, msg)
+                        messages.append((user_id, msg))
+        db.create_transfers(transfers)
+        return messages
+
+    def update_trueskill_ratings(game_id, game_result, teams) -> None:
+        """Update the TrueSkill ratings of the players based on the outcome of a game
+
+        :param int game_id: id of the game
+        :param GameStatus game_result: Result of the game
+        :param Tuple[List[discord.Member], List[discord.Member]] teams: Tuple of List per team of discord.Member
+        """
+        data = db.get_trueskill_ratings([player.id for team in teams for player in team])
+        team_ratings = ()
+        for team in teams:
+            team_rating = []
+            for player in team:
+                if player.id in data:
+                    team_rating.append(Rating(data[player.id][0], data[player.id][1]))
+                else:
+                    team_rating.append(Rating())
+            team_ratings += (team_rating,)
+        ranks = [0, 0]
+        if game_result == GameStatus.TEAM1:
+            ranks = [0, 1]
+        elif game_result == GameStatus.TEAM2:
+            ranks = [1, 0]
+        new_team_ratings = rate([team_ratings[0], team_ratings[1]], ranks)
+        ratings = [(player.id, rating) for team, new_team_rating in zip(teams, new_team_ratings)
+                   for player, rating in zip(team, new_team_rating)]
+        db.new_trueskill_ratings(game_id, ratings)
+        # The cached ratings of these players in other running games are outdated now
+        for cached_ratings in game_ratings.values():
+            for player_id, rating in ratings:
+                cached_ratings.pop(player_id, None)
 
     async def replaced_captain(message):
         success = False
         new_capt, old_capt = message.content.replace('`', '').replace(' as captain', '').split(' has replaced ')
         new_capt_id_str = str((await query_members(new_capt)).id)
         old_capt_id_str = str((await query_members(old_capt)).id)
-        data = db.get_games_by_status(GameStatus.PICKING)
-        data += db.get_games_by_status(GameStatus.INPROGRESS)
+        data = db.get_games_by_status(GameStatus.PICKING, GameStatus.INPROGRESS)
         games = []
         for game in data:
             if game[1].startswith(old_capt_id_str) or game[2].startswith(old_capt_id_str):
@@ -1589,7 +1782,8 @@ def start_bot(db, ts, logger):
             game_id = games[-1][0]
             team1 = games[-1][1]
             team2 = games[-1][2]
-            if (old_capt_id_str in team1 or team2) and (new_capt_id_str in team1 or team2):
+            players = f'{team1} {team2}'
+            if old_capt_id_str in players and new_capt_id_str in players:
                 team1 = team1.replace(old_capt_id_str, '#')
                 team2 = team2.replace(old_capt_id_str, '#')
                 team1 = team1.replace(new_capt_id_str, old_capt_id_str)
@@ -1608,8 +1802,7 @@ def start_bot(db, ts, logger):
         old_player, new_player = message.content.replace('`', '').split(' has been substituted with ')
         old_player_id_str = str((await query_members(old_player)).id)
         new_player_id_str = str((await query_members(new_player)).id)
-        data = db.get_games_by_status(GameStatus.PICKING)
-        data += db.get_games_by_status(GameStatus.INPROGRESS)
+        data = db.get_games_by_status(GameStatus.PICKING, GameStatus.INPROGRESS)
         games = []
         for game in data:
             if old_player_id_str in game[1] or old_player_id_str in game[2]:
@@ -1647,8 +1840,10 @@ def start_bot(db, ts, logger):
             team1_ids = [int(i) for i in teams[0].split()]
             team2_ids = [int(i) for i in teams[1].split()]
             if success:
+                game_ratings.get(game_id, {}).pop(int(old_player_id_str), None)
                 if status == GameStatus.INPROGRESS:
-                    team1_win_chance = calculate_win_chance(db, (team1_ids, team2_ids))
+                    player_ratings = get_game_ratings(game_id, team1_ids + team2_ids)
+                    team1_win_chance = calculate_win_chance(player_ratings, (team1_ids, team2_ids))
                     if team1_win_chance > 0:
                         result_msg = (f'Player subbed, new prediction: Team 1 ({team1_win_chance:.1%}), Team 2 '
                                       f'({(1 - team1_win_chance):.1%}).')
@@ -1658,7 +1853,8 @@ def start_bot(db, ts, logger):
                 else:
                     player_ids = [team1_ids[0], team2_ids[0]]
                     player_ids.extend(team1_ids[1:])
-                    best_team1_ids, best_team2_ids, best_chance_to_draw = suggest_even_teams(db, player_ids)
+                    player_ratings = get_game_ratings(game_id, player_ids)
+                    best_team1_ids, best_team2_ids, best_chance_to_draw = suggest_even_teams(player_ratings, player_ids)
                     team1_str = '<@!' + '>, <@!'.join([str(i) for i in best_team1_ids]) + '>'
                     team2_str = '<@!' + '>, <@!'.join([str(i) for i in best_team2_ids]) + '>'
                     result_msg = (f'Suggested teams: {team1_str} versus {team2_str} ({best_chance_to_draw:.1%} chance '
@@ -1707,7 +1903,8 @@ def start_bot(db, ts, logger):
             if success:
                 team1_ids = [int(i) for i in teams[0].split()]
                 team2_ids = [int(i) for i in teams[1].split()]
-                team1_win_chance = calculate_win_chance(db, (team1_ids, team2_ids))
+                player_ratings = get_game_ratings(game_id, team1_ids + team2_ids)
+                team1_win_chance = calculate_win_chance(player_ratings, (team1_ids, team2_ids))
                 if team1_win_chance > 0:
                     result_msg = (f'Player swapped, new prediction: Team 1 ({team1_win_chance:.1%}), Team 2 '
                                   f'({(1 - team1_win_chance):.1%}).')
@@ -1781,11 +1978,24 @@ def start_bot(db, ts, logger):
         else:
             await ctx.message.add_reaction(REACTIONS[False])
 
+    bullybot_handlers = {
+        'begun': game_begun,
+        'picked': game_picked,
+        'cancelled': game_cancelled,
+        'finished': game_finished,
+        'replaced': replaced_captain,
+        'substituted': sub_player,
+        'swapped': swap_player,
+    }
+
     @bot.event
     async def on_message(message):
-        # Log messages for debugging purposes
-        if (message.author.id == BULLYBOT_DISCORD_ID
-                or message.author.id == DISCORD_ID):
+        # Messages from users can only be commands
+        if message.author.id not in LOGGED_AUTHOR_IDS:
+            await bot.process_commands(message)
+            return
+        # Log messages for debugging purposes, skipping the formatting unless debug logging is enabled
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f'{message.author} wrote in #{message.channel} on '
                          f'{message.guild}:')
             for line in message.content.split('\n'):
@@ -1796,29 +2006,16 @@ def start_bot(db, ts, logger):
                     for line in embed.description.split('\n'):
                         logger.debug(f'\t\t{line}')
         # Parse BullyBot's messages for game info
-        if ((message.author.id == BULLYBOT_DISCORD_ID or (DEBUG and message.author.id == DISCORD_ID))
-                and message.channel.id == PUG_CHANNEL_ID):
-            if 'Game' in message.content:
-                if 'begun' in message.content:
-                    await game_begun(message)
-                elif 'picked' in message.content:
-                    await game_picked(message)
-                elif 'cancelled' in message.content:
-                    await game_cancelled(message)
-                elif 'finished' in message.content:
-                    await game_finished(message)
-            elif 'has replaced' and 'as captain' in message.content:
-                await replaced_captain(message)
-            elif 'has been substituted with' in message.content:
-                await sub_player(message)
-            elif 'has been swapped with' in message.content:
-                await swap_player(message)
+        if message.author.id in GAME_INFO_AUTHOR_IDS and message.channel.id == PUG_CHANNEL_ID:
+            match = BULLYBOT_MESSAGE_PATTERN.search(message.content)
+            if match:
+                await bullybot_handlers[match.lastgroup](message)
         await bot.process_commands(message)
 
     @bot.event
     async def on_command_error(ctx, error):
         if isinstance(error, commands.errors.CommandNotFound):
-            logger.debug(f'({ctx.author.display_name}) {ctx.message.content}: {error}')
+            logger.debug('(%s) %s: %s', ctx.author.display_name, ctx.message.content, error)
         elif isinstance(error, commands.errors.CommandInvokeError):
             logger.error(f'({ctx.author.display_name}) {ctx.message.content}: {error}')
 
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 """find twitch midair: community edition streams for shazbuckbot"""
+import time
+
 import requests
 
 TWITCH_GAME_ID = "517069"  # midair community edition
+TOKEN_EXPIRY_MARGIN = 60  # Seconds
 
 
 class TwitchStreams:
@@ -16,18 +19,22 @@ class TwitchStreams:
         self.twitch_client_id = twitch_client_id
         self.twitch_client_secret = twitch_client_secret
         self.twitch_access_token = ''
+        self.twitch_token_expiry = 0.0
+        # Reuse the connection to twitch between requests
+        self.session = requests.Session()
 
     def get_token(self) -> str:
-        """Get a new OAuth client acccess token
+        """Get a new OAuth client acccess token and remember when it expires
 
         :return: A OAuth client access token
         """
         url = (f'https://id.twitch.tv/oauth2/token?client_id={self.twitch_client_id}'
                f'&client_secret={self.twitch_client_secret}&grant_type=client_credentials')
-        response = requests.post(url)
+        response = self.session.post(url)
 
         if response.status_code == 200:
             response_json = response.json()
+            self.twitch_token_expiry = time.monotonic() + response_json['expires_in'] - TOKEN_EXPIRY_MARGIN
             return response_json['access_token']
         else:
             response_json = response.json()
@@ -38,30 +45,23 @@ class TwitchStreams:
 
         :return: A dictionary with the details of the found streams
         """
-        if not self.twitch_access_token or not self.validate_token():
-            try:
-                self.twitch_access_token = self.get_token()
-            except PermissionError as error:
-                raise PermissionError(error)
-        headers = {
-            'Content-type': 'application/json',
-            'Authorization': f'Bearer {self.twitch_access_token}',
-            'Client-Id': f'{self.twitch_client_id}',
-        }
+        if not self.twitch_access_token or time.monotonic() >= self.twitch_token_expiry:
+            self.twitch_access_token = self.get_token()
         url = f'https://api.twitch.tv/helix/streams?first=5&game_id={TWITCH_GAME_ID}'
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=self.get_headers())
+        if response.status_code == 401:
+            # The token was revoked before it expired, get a new one and try once more
+            self.twitch_access_token = self.get_token()
+            response = self.session.get(url, headers=self.get_headers())
         return response.json()
 
-    def validate_token(self) -> bool:
-        """Validate the current client access token
+    def get_headers(self) -> dict:
+        """Get the headers to authenticate a request with the current client access token
 
-        :return: Boolean to indicate if the current token is valid
+        :return: A dictionary with the request headers
         """
-        headers = {
+        return {
             'Content-type': 'application/json',
             'Authorization': f'Bearer {self.twitch_access_token}',
             'Client-Id': f'{self.twitch_client_id}',
         }
-        url = f'https://id.twitch.tv/oauth2/validate'
-        response = requests.get(url, headers=headers)
-        return response.status_code == 200
@@ -6,7 +6,9 @@ import yaml
 import sqlite3
 
 
-config = yaml.safe_load(open("../config.yml"))
+# Use the libyaml parser when available
+with open("../config.yml") as config_file:
+    config = yaml.load(config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 DATABASE = config['database']
 GAME_STATUS = IntEnum('Game_Status', 'Picking Cancelled InProgress Team1 Team2 Tied')
 WAGER_RESULT = IntEnum('Wager_Result', 'InProgress Won Lost Canceled')
@@ -5,7 +5,9 @@ from math import ceil
 import yaml
 import sqlite3
 
-config = yaml.safe_load(open("../config.yml"))
+# Use the libyaml parser when available
+with open("../config.yml") as config_file:
+    config = yaml.load(config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 DATABASE: str = config['database']
 DISCORD_ID: int = config['discord_id']
 
@@ -4,9 +4,13 @@
 from enum import IntEnum, auto
 import yaml
 import sqlite3
-from trueskill import Rating, rate, quality, backends
+import json
+import numpy as np
+from trueskill import Rating, rate, quality, backends, global_env
 
 FIRST_GAME_ID = 495
+# Convergence threshold of the rating updates, two team games converge after one pass regardless
+MIN_DELTA = 0.01
 
 
 class GameStatus(IntEnum):
@@ -18,10 +22,17 @@ class GameStatus(IntEnum):
     TIED = auto()
 
 
-config = yaml.safe_load(open("../config.yml"))
+# Use the libyaml parser when available
+with open("../config.yml") as config_file:
+    config = yaml.load(config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 DATABASE = config['database']
 
 conn = sqlite3.connect(DATABASE)
+# Same journal settings as the bot, with a larger cache for the bulk rebuild
+conn.execute("PRAGMA journal_mode = WAL")
+conn.execute("PRAGMA synchronous = NORMAL")
+conn.execute("PRAGMA temp_store = MEMORY")
+conn.execute("PRAGMA cache_size = -131072")
 
 cur = conn.cursor()
 sql = ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='trueskills' '''
@@ -40,9 +51,14 @@ conn.execute("""
         trueskill FLOAT NOT NULL
     );
 """)
+conn.execute(''' CREATE INDEX IF NOT EXISTS idx_trueskills_discord_game ON trueskills(discord_id, game_id) ''')
 
 player_ratings = {}
 number_of_games = {}
+rated_players = []
+rated_game_ids = []
+mus = []
+sigmas = []
 backends.choose_backend('scipy')
 values = (FIRST_GAME_ID, GameStatus.TEAM1, GameStatus.TEAM2, GameStatus.TIED)
 sql = ''' SELECT id, team1, team2, status 
@@ -55,17 +71,17 @@ cur.execute(sql, values)
 games = cur.fetchall()
 for game in games:
     game_id: int = game[0]
-    team1_str: str = game[1]
-    team2_str: str = game[2]
+    team1_players = game[1].split()
+    team2_players = game[2].split()
     status: int = game[3]
-    if len(team1_str.split()) == 5 or len(team2_str.split()) == 5:
+    if len(team1_players) == 5 or len(team2_players) == 5:
         team1_skills = []
-        for player in team1_str.split():
+        for player in team1_players:
             if player not in player_ratings:
                 player_ratings[player] = Rating()
             team1_skills.append(player_ratings[player])
         team2_skills = []
-        for player in team2_str.split():
+        for player in team2_players:
             if player not in player_ratings:
                 player_ratings[player] = Rating()
             team2_skills.append(player_ratings[player])
@@ -76,34 +92,31 @@ for game in games:
             ranks = [1, 0]
         draw_chance = quality([team1_skills, team2_skills])
         print(f'id: {game_id}, chance to draw: {draw_chance:.2f}, result: {GameStatus(status).name}.')
-        (new_team1_skills, new_team2_skills) = rate([team1_skills, team2_skills], ranks)
-        for idx, player in enumerate(team1_str.split()):
-            rating = new_team1_skills[idx]
+        (new_team1_skills, new_team2_skills) = rate([team1_skills, team2_skills], ranks, min_delta=MIN_DELTA)
+        for player, rating in zip(team1_players + team2_players, new_team1_skills + new_team2_skills):
             player_ratings[player] = rating
-            trueskill_update = (player, game_id, rating.mu, rating.sigma, rating.exposure)
-            sql = ''' INSERT INTO trueskills(discord_id, game_id, mu, sigma, trueskill)
-                      VALUES(?, ?, ?, ?, ?) '''
-            cur = conn.cursor()
-            cur.execute(sql, trueskill_update)
-        for idx, player in enumerate(team2_str.split()):
-            rating = new_team2_skills[idx]
-            player_ratings[player] = rating
-            trueskill_update = (player, game_id, rating.mu, rating.sigma, rating.exposure)
-            sql = ''' INSERT INTO trueskills(discord_id, game_id, mu, sigma, trueskill)
-                      VALUES(?, ?, ?, ?, ?) '''
-            cur = conn.cursor()
-            cur.execute(sql, trueskill_update)
-for player in player_ratings.keys():
-    player_nick = player
-    sql = ''' SELECT nick FROM users WHERE discord_id = ? '''
-    cur = conn.cursor()
-    cur.execute(sql, (player,))
-    user = cur.fetchone()
-    if user:
-        player_nick = user[0]
+            rated_players.append(player)
+            rated_game_ids.append(game_id)
+            mus.append(rating.mu)
+            sigmas.append(rating.sigma)
+# Compute the exposures of all the new ratings at once, the same way as Rating.exposure
+env = global_env()
+exposures = (np.array(mus) - (env.mu / env.sigma) * np.array(sigmas)).tolist()
+# Store all the new ratings at once, in a single transaction
+sql = ''' INSERT INTO trueskills(discord_id, game_id, mu, sigma, trueskill)
+          VALUES(?, ?, ?, ?, ?) '''
+with conn:
+    conn.executemany(sql, zip(rated_players, rated_game_ids, mus, sigmas, exposures))
+# Look up the nicks of all rated players at once
+players = list(player_ratings.keys())
+sql = ''' SELECT discord_id, nick FROM users WHERE discord_id IN (SELECT value FROM json_each(?)) '''
+cur = conn.cursor()
+cur.execute(sql, (json.dumps(players),))
+nicks = {str(discord_id): nick for (discord_id, nick) in cur.fetchall()}
+for player in players:
+    player_nick = nicks.get(player, player)
     rating = player_ratings[player]
     print(f'player: {player_nick}, mu: {rating.mu:.2f}, sigma: {rating.sigma:.2f}, '
           f'trueskill: {rating.exposure:.2f}.')
 print(f'number of games analyzed: {len(games)}')
-conn.commit()
 conn.close()
@@ -6,28 +6,62 @@ import sys
 
 import yaml
 import sqlite3
+import json
 
 import os
-
-os.environ['MPLCONFIGDIR'] = '/opt/shazbuckbot/www/matplotlib'
-import matplotlib
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
-plt.style.use('ggplot')
-import matplotlib.dates as md
-
-import datetime as dt
+import glob
+import hashlib
 
 import cgi
 import cgitb
 
 cgitb.enable()
 
-config = yaml.safe_load(open("/opt/shazbuckbot/config.yml"))
+# Use the libyaml parser when available
+with open("/opt/shazbuckbot/config.yml") as config_file:
+    config = yaml.load(config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 DATABASE = config['database']
 PLOT_COLORS = ['b', 'r', 'g', 'c', 'm', 'y', 'w']
+CACHE_DIR = '/opt/shazbuckbot/www/graph_cache'
+MAX_CACHED_GRAPHS = 500
+MAX_PLOT_POINTS = 600
+
+
+def send_image(image):
+    sys.stdout.buffer.write(b'Content-type: image/png\r\n')
+    sys.stdout.buffer.write(b'\r\n')
+    sys.stdout.buffer.write(image)
+
+
+def downsample_lttb(x, y, threshold):
+    """Downsample a line with the Largest-Triangle-Three-Buckets algorithm
+
+    :param numpy.ndarray x: The x values
+    :param numpy.ndarray y: The y values
+    :param int threshold: The maximum number of points to keep
+    :return: Tuple of the downsampled x and y values
+    """
+    n = len(x)
+    if n <= threshold or threshold < 3:
+        return x, y
+    # The first and last point are always kept, the others are split into buckets
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(int) + 1
+    edges = np.append(edges, n)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket, which is only the last point for the final bucket
+        next_end = edges[i + 2] if i + 2 < threshold - 1 else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        # Keep the point forming the largest triangle with the previously kept point and the next average
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected.append(a)
+    selected.append(n - 1)
+    return x[selected], y[selected]
+
 
 # get cgi object
 form = cgi.FieldStorage()
@@ -37,58 +71,89 @@ if form.getlist('discord_id'):
 else:
     discord_ids = ['292031989773500416', '347125254050676738']
 
+# Fetch the nicks and ratings of all requested players in two queries
+discord_ids = [int(discord_id) for discord_id in discord_ids if discord_id.isdigit()]
+conn = sqlite3.connect(DATABASE)
+cur = conn.cursor()
+sql = ''' SELECT discord_id, nick FROM users WHERE discord_id IN (SELECT value FROM json_each(?)) '''
+cur.execute(sql, (json.dumps(discord_ids),))
+nicks_by_discord_id = dict(cur.fetchall())
+sql = ''' SELECT discord_id, pick_time, trueskill
+          FROM trueskills, games 
+          WHERE discord_id IN (SELECT value FROM json_each(?)) AND games.id = game_id
+          ORDER BY trueskills.id '''
+cur.execute(sql, (json.dumps(discord_ids),))
+ratings_by_discord_id = {}
+for row in cur.fetchall():
+    ratings_by_discord_id.setdefault(row[0], []).append(row[1:])
+conn.close()
+
+players = [(nicks_by_discord_id.get(discord_id, str(discord_id)), ratings_by_discord_id.get(discord_id, []))
+           for discord_id in discord_ids]
+
+# Serve the previously rendered graph if the plotted data did not change since, the ratings are fingerprinted
+# as a whole because trueskill_recalc rewrites them without changing the number of rows
+cache_name = hashlib.md5(f'{discord_ids}'.encode()).hexdigest()
+data_hash = hashlib.md5(repr(players).encode()).hexdigest()
+cache_file = os.path.join(CACHE_DIR, f'trueskill-{cache_name}-{data_hash}.png')
+# Only graphs of existing players are cached, so made up id lists cannot fill the cache
+cacheable = (bool(discord_ids) and len(set(discord_ids)) == len(discord_ids)
+             and all(discord_id in nicks_by_discord_id for discord_id in discord_ids))
+if cacheable and os.path.isfile(cache_file):
+    with open(cache_file, 'rb') as f:
+        send_image(f.read())
+    # Mark the graph as recently used, the least recently used graphs are evicted first
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    sys.exit()
+
+os.environ['MPLCONFIGDIR'] = '/opt/shazbuckbot/www/matplotlib'
+import matplotlib
+
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+plt.style.use('ggplot')
+import matplotlib.dates as md
+import numpy as np
+
 # Set up the plot
 fig, ax = plt.subplots(figsize=(8, 6))
 color_index = 0
 
 nicks = []
 
-for discord_id in discord_ids:
-
-    if discord_id.isdigit():
-
-        conn = sqlite3.connect(DATABASE)
+for (nick, data) in players:
 
-        nick = str(discord_id)
-        sql = ''' SELECT nick FROM users WHERE discord_id = ? '''
-        cur = conn.cursor()
-        cur.execute(sql, (discord_id,))
-        user = cur.fetchone()
-        if user:
-            nick = user[0]
-        nicks.append(nick)
+    nicks.append(nick)
 
-        cur = conn.cursor()
-        sql = ''' SELECT pick_time, trueskill 
-                  FROM trueskills, games 
-                  WHERE discord_id = ? AND games.id = game_id '''
-        values = (int(discord_id),)
-        cur.execute(sql, values)
-        data = cur.fetchall()
-        conn.close()
+    if data:
 
-        if data:
+        timestamps = []
+        trueskills = []
 
-            timestamps = []
-            trueskills = []
+        for d in data:
 
-            for d in data:
+            pick_time: int = d[0]
+            trueskill: float = d[1]
 
-                pick_time: int = d[0]
-                trueskill: float = d[1]
+            timestamps.append(pick_time)
+            trueskills.append(trueskill)
 
-                timestamps.append(pick_time)
-                trueskills.append(trueskill)
+        # Convert the unix timestamps to plot dates without creating a datetime per point
+        datenums = md.date2num(np.asarray(timestamps, dtype='datetime64[s]'))
 
-            dates = [dt.datetime.fromtimestamp(ts) for ts in timestamps]
-            datenums = md.date2num(dates)
+        # Long histories have far more points than the graph can show
+        (datenums, trueskills) = downsample_lttb(datenums, np.array(trueskills), MAX_PLOT_POINTS)
 
-            # Plot the data
-            label_txt = f'{nick} ({len(dates)} games)'
-            ax.plot(datenums, trueskills, ls='-', drawstyle='steps-post', color=PLOT_COLORS[color_index],
-                    label=label_txt)
+        # Plot the data
+        label_txt = f'{nick} ({len(data)} games)'
+        ax.plot(datenums, trueskills, ls='-', drawstyle='steps-post', color=PLOT_COLORS[color_index],
+                label=label_txt)
 
-            color_index = (color_index + 1) % len(PLOT_COLORS)
+        color_index = (color_index + 1) % len(PLOT_COLORS)
 
 # Finish plot
 ax.set_ylabel('TrueSkill')
@@ -100,11 +165,26 @@ ax.legend()
 ax.text(1.0, 0.5, 'TrueSkill by RedFox', transform=ax.transAxes, fontsize=10, color='gray',
         alpha=0.25, ha='right', va='center', rotation='vertical')
 
-# Save the image to buffer
+# Save the image to buffer, favouring encoding speed over file size
 buf = BytesIO()
-fig.savefig(buf, format='png')
+fig.savefig(buf, format='png', pil_kwargs={'compress_level': 1})
+
+# Replace any outdated graph of these players in the cache and evict the least recently used graphs beyond
+# the limit, a failing cache should not fail the request
+if cacheable:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for outdated_file in glob.glob(os.path.join(CACHE_DIR, f'trueskill-{cache_name}-*.png')):
+            os.remove(outdated_file)
+        temp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(buf.getvalue())
+        os.replace(temp_file, cache_file)
+        cached_files = sorted(glob.glob(os.path.join(CACHE_DIR, '*.png')), key=os.path.getmtime)
+        for evicted_file in cached_files[:-MAX_CACHED_GRAPHS]:
+            os.remove(evicted_file)
+    except OSError:
+        pass
 
 # Send the image
-sys.stdout.buffer.write(b'Content-type: image/png\r\n')
-sys.stdout.buffer.write(b'\r\n')
-sys.stdout.buffer.write(buf.getvalue())
+send_image(buf.getvalue())
@@ -6,16 +6,11 @@ import sys
 
 import yaml
 import sqlite3
+import json
 
 import os
-os.environ['MPLCONFIGDIR'] = '/opt/shazbuckbot/www/matplotlib'
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
-import matplotlib.dates as md
-
-import datetime as dt
+import glob
+import hashlib
 
 from distutils.util import strtobool
 
@@ -23,9 +18,20 @@ import cgi
 import cgitb
 cgitb.enable()
 
-config = yaml.safe_load(open("/opt/shazbuckbot/config.yml"))
+# Use the libyaml parser when available
+with open("/opt/shazbuckbot/config.yml") as config_file:
+    config = yaml.load(config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 DATABASE = config['database']
 PLOT_COLORS = ['b', 'r', 'g', 'c', 'm', 'y', 'w']
+CACHE_DIR = '/opt/shazbuckbot/www/graph_cache'
+MAX_CACHED_GRAPHS = 500
+
+
+def send_image(image):
+    sys.stdout.buffer.write(b'Content-type: image/png\r\n')
+    sys.stdout.buffer.write(b'\r\n')
+    sys.stdout.buffer.write(image)
+
 
 # get cgi object
 form = cgi.FieldStorage()
@@ -40,6 +46,45 @@ if form.getfirst('gift'):
 else:
     gift = False
 
+# Fetch the transfers of all requested users in a single query
+discord_ids = [int(discord_id) for discord_id in discord_ids if discord_id.isdigit()]
+sql = ''' SELECT discord_id, users.id, nick, sender, receiver, amount, transfer_time
+          FROM users, transfers 
+          WHERE discord_id IN (SELECT value FROM json_each(?)) AND (sender = users.id OR receiver = users.id)
+          ORDER BY transfers.id '''
+conn = sqlite3.connect(DATABASE)
+cur = conn.cursor()
+cur.execute(sql, (json.dumps(discord_ids),))
+transfers_by_discord_id = {}
+for row in cur.fetchall():
+    transfers_by_discord_id.setdefault(row[0], []).append(row[1:])
+conn.close()
+
+# Serve the previously rendered graph if the plotted data, including the nicks, did not change since
+cache_name = hashlib.md5(f'{discord_ids} {gift}'.encode()).hexdigest()
+data_hash = hashlib.md5(repr(sorted(transfers_by_discord_id.items())).encode()).hexdigest()
+cache_file = os.path.join(CACHE_DIR, f'balance-{cache_name}-{data_hash}.png')
+# Only graphs of existing users with transfers are cached, so made up id lists cannot fill the cache
+cacheable = (bool(discord_ids) and len(set(discord_ids)) == len(discord_ids)
+             and all(discord_id in transfers_by_discord_id for discord_id in discord_ids))
+if cacheable and os.path.isfile(cache_file):
+    with open(cache_file, 'rb') as f:
+        send_image(f.read())
+    # Mark the graph as recently used, the least recently used graphs are evicted first
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    sys.exit()
+
+os.environ['MPLCONFIGDIR'] = '/opt/shazbuckbot/www/matplotlib'
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+plt.style.use('ggplot')
+import matplotlib.dates as md
+import numpy as np
+
 # Set up the plot
 fig, ax = plt.subplots(figsize=(8, 6))
 color_index = 0
@@ -48,59 +93,31 @@ nicks = []
 
 for discord_id in discord_ids:
 
-    if discord_id.isdigit():
-        sql = ''' SELECT users.id, nick, sender, receiver, amount, transfer_time 
-                  FROM users, transfers 
-                  WHERE discord_id = ? AND (sender = users.id OR receiver = users.id) '''
-        values = (int(discord_id),)
-    
-        conn = sqlite3.connect(DATABASE)
-        cur = conn.cursor()
-        cur.execute(sql, values)
-        data = cur.fetchall()
-        conn.close()
-    
-        if data:
-    
-            user_id: int = data[0][0]
-            nick: str = data[0][1]
-            nicks.append(nick)
-    
-            balance = 0
-            balances = []
-            gift_balance = 0
-            gift_balances = []
-            timestamps = []
-    
-            for d in data:
-                sender: int = d[2]
-                receiver: int = d[3]
-                amount: int = d[4]
-                transfer_time: int = d[5]
-    
-                if sender == user_id and receiver != user_id:
-                    balance -= amount
-                    if gift and receiver != 1:
-                        gift_balance -= amount
-
-                if sender != user_id and receiver == user_id:
-                    balance += amount
-                    if gift and sender != 1:
-                        gift_balance += amount
-                
-                balances.append(balance)
-                if gift:
-                    gift_balances.append(gift_balance)
-                timestamps.append(transfer_time)
-    
-            dates = [dt.datetime.fromtimestamp(ts) for ts in timestamps]
-            datenums = md.date2num(dates)
-    
-            # Plot the data
-            ax.plot(datenums, balances, ls='-', drawstyle='steps-post', color=PLOT_COLORS[color_index], label=nick)
-            if gift:
-                ax.plot(datenums, gift_balances, ls='-.', drawstyle='steps-post', color=PLOT_COLORS[color_index], label=f'{nick} Gifts')
-            color_index = (color_index + 1) % len(PLOT_COLORS)
+    data = transfers_by_discord_id.get(discord_id)
+    if data:
+
+        user_id: int = data[0][0]
+        nick: str = data[0][1]
+        nicks.append(nick)
+
+        # Balance changes per transfer, transfers to oneself do not change the balance
+        (senders, receivers, amounts, timestamps) = np.array([d[2:6] for d in data]).T
+        outgoing = (senders == user_id) & (receivers != user_id)
+        incoming = (senders != user_id) & (receivers == user_id)
+        balances = np.cumsum(np.where(incoming, amounts, 0) - np.where(outgoing, amounts, 0))
+        if gift:
+            # Only count transfers with other users, not with the bot
+            gift_balances = np.cumsum(np.where(incoming & (senders != 1), amounts, 0)
+                                      - np.where(outgoing & (receivers != 1), amounts, 0))
+
+        # Convert the unix timestamps to plot dates without creating a datetime per point
+        datenums = md.date2num(np.asarray(timestamps, dtype='datetime64[s]'))
+
+        # Plot the data
+        ax.plot(datenums, balances, ls='-', drawstyle='steps-post', color=PLOT_COLORS[color_index], label=nick)
+        if gift:
+            ax.plot(datenums, gift_balances, ls='-.', drawstyle='steps-post', color=PLOT_COLORS[color_index], label=f'{nick} Gifts')
+        color_index = (color_index + 1) % len(PLOT_COLORS)
 
 # Finish plot
 ax.set_ylabel('Shazbucks')
@@ -112,11 +129,26 @@ ax.legend()
 ax.text(1.0, 0.5, 'Shazbucks by RedFox', transform=ax.transAxes, fontsize=10, color='gray',
         alpha=0.25, ha='right', va='center', rotation='vertical')
 
-# Save the image to buffer
+# Save the image to buffer, favouring encoding speed over file size
 buf = BytesIO()
-fig.savefig(buf, format='png')
+fig.savefig(buf, format='png', pil_kwargs={'compress_level': 1})
+
+# Replace any outdated graph of these users in the cache and evict the least recently used graphs beyond
+# the limit, a failing cache should not fail the request
+if cacheable:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for outdated_file in glob.glob(os.path.join(CACHE_DIR, f'balance-{cache_name}-*.png')):
+            os.remove(outdated_file)
+        temp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(buf.getvalue())
+        os.replace(temp_file, cache_file)
+        cached_files = sorted(glob.glob(os.path.join(CACHE_DIR, '*.png')), key=os.path.getmtime)
+        for evicted_file in cached_files[:-MAX_CACHED_GRAPHS]:
+            os.remove(evicted_file)
+    except OSError:
+        pass
 
 # Send the image
-sys.stdout.buffer.write(b'Content-type: image/png\r\n')
-sys.stdout.buffer.write(b'\r\n')
-sys.stdout.buffer.write(buf.getvalue())
+send_image(buf.getvalue())
@@ -10,7 +10,9 @@ import json
 
 print("Content-Type:application/json;charset=utf-8\n")
 
-config = yaml.safe_load(open("/opt/shazbuckbot/config.yml"))
+# Use the libyaml parser when available
+with open("/opt/shazbuckbot/config.yml") as config_file:
+    config = yaml.load(config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 DATABASE = config['database']
 
 # get cgi object
@@ -26,9 +28,10 @@ if form.getvalue('discord_id'):
         values = (int(discord_id),)
 
 conn = sqlite3.connect(DATABASE)
+conn.row_factory = sqlite3.Row
 cur = conn.cursor()
 cur.execute(sql, values)
-data = [dict((cur.description[i][0], value) for i, value in enumerate(row)) for row in cur.fetchall()]
+data = [dict(row) for row in cur]
 conn.close()
 
 if data: